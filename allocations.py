@@ -0,0 +1,167 @@
+# allocations.py
+
+"""
+This module lets sharded checkouts take stock without writing to the catalog.
+
+Each shard sells from stock the catalog allocated to it ahead of time. The catalog
+records per shard and product the units allocated, and the units sold and released
+it has reconciled so far; the shard records the units it actually sold and released,
+in the same transaction as its orders. A checkout therefore only writes to the user's
+shard, unless the shard ran out and takes another chunk from the catalog. The outbox
+then reconciles the shard's totals into the catalog, taking sold units out of the
+products' stock.
+
+Totals only grow, so a stale allocation only understates what a shard may sell and
+reconciling the same totals twice changes nothing.
+"""
+
+from typing import Dict, Iterable, Optional
+from sqlalchemy import bindparam, func, insert, select, update
+from sqlalchemy.orm import Session
+from models import Product, ShardStock, StockAllocation
+from catalog import next_version
+
+def free_stock(catalog: Session, product_ids: Iterable[int]) -> Dict[int, int]:
+    """
+    Return the stock of each product that is not allocated to a shard.
+
+    Units a shard sold or released since the last reconciliation still count as
+    allocated, so this never overstates the free stock.
+    """
+    product_ids = list(product_ids)
+    outstanding = select(
+        StockAllocation.product_id,
+        func.sum(StockAllocation.quantity - StockAllocation.sold - StockAllocation.released).label('units'),
+    ).where(StockAllocation.product_id.in_(product_ids)).group_by(StockAllocation.product_id).subquery()
+    return dict(catalog.query(Product.id, Product.stock - func.coalesce(outstanding.c.units, 0)).outerjoin(
+        outstanding, outstanding.c.product_id == Product.id).filter(Product.id.in_(product_ids)))
+
+def allocate_stock(catalog: Session, shard: int, product_id: int, needed: int, chunk: int, shards: int) -> bool:
+    """
+    Allocate at least `needed` more units of a product to a shard, in one catalog transaction.
+
+    Up to `chunk` units are allocated at once, but no more than the shard's share of
+    the free stock, so scarce products stay sellable from every shard.
+
+    Returns False if fewer than `needed` units are free.
+    """
+    catalog.rollback()  # Read the free stock in the write transaction, not an older snapshot
+    # Taking the write lock first keeps concurrent allocations from handing out the same units
+    catalog.execute(insert(StockAllocation).prefix_with('OR IGNORE'), [{'shard': shard, 'product_id': product_id}])
+    free = free_stock(catalog, [product_id]).get(product_id, 0)
+    if free < needed:
+        catalog.rollback()
+        return False
+    catalog.query(StockAllocation).filter_by(shard=shard, product_id=product_id).update(
+        {StockAllocation.quantity: StockAllocation.quantity + max(needed, min(chunk, free // shards))},
+        synchronize_session=False)
+    catalog.commit()
+    return True
+
+def take_stock(catalog: Session, db: Session, shard: int, quantities: Dict[int, int], chunk: int,
+               shards: int) -> Optional[int]:
+    """
+    Take the ordered quantities, by product id, from the stock allocated to a shard.
+
+    The shard's totals change in `db`, which the caller commits with the order.
+    Products whose allocation falls short get another from the catalog first.
+
+    Returns the id of a product without enough stock, or None once everything is taken.
+    """
+    allocated = dict(catalog.query(StockAllocation.product_id, StockAllocation.quantity).filter(
+        StockAllocation.shard == shard, StockAllocation.product_id.in_(quantities)))
+    # Taking the shard's write lock first keeps concurrent checkouts from selling the same units
+    db.execute(insert(ShardStock).prefix_with('OR IGNORE'), [{'product_id': product_id} for product_id in quantities])
+    totals = {product_id: (sold, released) for product_id, sold, released in db.query(
+        ShardStock.product_id, ShardStock.sold, ShardStock.released).filter(ShardStock.product_id.in_(quantities))}
+    for product_id, quantity in quantities.items():
+        missing = sum(totals[product_id]) + quantity - allocated.get(product_id, 0)
+        if missing > 0 and not allocate_stock(catalog, shard, product_id, missing, chunk, shards):
+            return product_id
+    db.execute(update(ShardStock), [{'product_id': product_id, 'sold': totals[product_id][0] + quantity}
+                                    for product_id, quantity in quantities.items()])
+    return None
+
+def reconcile_stock(catalog: Session, db: Session, shard: int, product_ids: Optional[Iterable[int]] = None) -> int:
+    """
+    Bring the catalog up to date with what a shard sold and released, in one catalog
+    transaction: units sold since the last reconciliation leave the products' stock.
+
+    Only `product_ids` are reconciled when given. Reconciliations of the same shard may
+    run concurrently and repeatedly, each total is only applied once.
+
+    Returns the number of products whose stock changed.
+    """
+    query = db.query(ShardStock.product_id, ShardStock.sold, ShardStock.released)
+    seen_query = catalog.query(StockAllocation.product_id, StockAllocation.sold, StockAllocation.released).filter(
+        StockAllocation.shard == shard)
+    if product_ids is not None:
+        product_ids = list(product_ids)
+        query = query.filter(ShardStock.product_id.in_(product_ids))
+        seen_query = seen_query.filter(StockAllocation.product_id.in_(product_ids))
+    totals = {product_id: (sold, released) for product_id, sold, released in query}
+    seen = {product_id: (sold, released) for product_id, sold, released in seen_query}
+    changed = 0
+    version: Optional[int] = None
+    for product_id, (sold, released) in totals.items():
+        if seen.get(product_id, (sold, released)) == (sold, released):
+            continue
+        seen_sold, seen_released = seen[product_id]
+        # Applied only if no concurrent reconciliation applied these totals first
+        if not catalog.query(StockAllocation).filter_by(
+                shard=shard, product_id=product_id, sold=seen_sold, released=seen_released).update(
+                {StockAllocation.sold: sold, StockAllocation.released: released}, synchronize_session=False):
+            continue
+        if sold > seen_sold:
+            version = version or next_version(catalog)
+            changed += catalog.query(Product).filter_by(id=product_id).update(
+                {Product.stock: Product.stock - (sold - seen_sold), Product.version: version},
+                synchronize_session=False)
+    catalog.commit()
+    return changed
+
+def release_unsold_stock(catalog: Session, db: Session, shard: int, below: Optional[int] = None) -> int:
+    """
+    Hand back a shard's unsold allocations of the products with fewer than `below` free
+    units, or of every product when `below` is None, so stock stranded in one shard
+    can be sold from the others. Products whose stock was lowered under what the
+    shards hold have negative free stock and are released too.
+
+    The shard records the release; `reconcile_stock` then frees the units in the catalog.
+
+    Returns the number of products released.
+    """
+    allocated = dict(catalog.query(StockAllocation.product_id, StockAllocation.quantity).filter(
+        StockAllocation.shard == shard))
+    if below is not None:
+        free = free_stock(catalog, allocated)
+        allocated = {product_id: quantity for product_id, quantity in allocated.items()
+                     if free.get(product_id, 0) < below}
+    if not allocated:
+        return 0
+    # A checkout that failed after its shard was allocated stock left no totals behind
+    db.execute(insert(ShardStock).prefix_with('OR IGNORE'), [{'product_id': product_id} for product_id in allocated])
+    # Allocations only grow, so what is allocated and unsold is never less than what was released
+    table = ShardStock.__table__
+    db.execute(update(table).where(table.c.product_id == bindparam('b_product_id')).values(
+        released=bindparam('b_quantity') - table.c.sold),
+        [{'b_product_id': product_id, 'b_quantity': quantity} for product_id, quantity in allocated.items()])
+    db.commit()
+    return len(allocated)
+
+def adopt_stock_totals(catalog: Session, db: Session, shard: int) -> None:
+    """
+    Give a shard of a new layout the totals the catalog reconciled for its index, so
+    it starts without any stock to sell.
+
+    Every shard of the old layout must have released and reconciled all its stock
+    first, which leaves nothing allocated and unsold under any index.
+    """
+    rows = [{'product_id': product_id, 'sold': sold, 'released': released}
+            for product_id, sold, released in catalog.query(
+                StockAllocation.product_id, StockAllocation.sold, StockAllocation.released).filter(
+                StockAllocation.shard == shard)]
+    db.query(ShardStock).delete(synchronize_session=False)
+    if rows:
+        db.execute(insert(ShardStock), rows)
+    db.commit()
@@ -4,17 +4,37 @@
 Main application module for the e-commerce backend.
 """
 
-from flask import Flask, render_template, redirect, url_for, request, flash, jsonify, session, abort
+from flask import Flask, render_template, stream_template, redirect, url_for, request, flash, jsonify, session, abort, get_flashed_messages, g
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from models import Base, User, Product, CartItem, Order, OrderItem
+from models import Base, User, Product, CartItem, Order, OrderItem, utcnow
+from database import missing_schema, upgrade_schema
+from cache import FragmentCache, render_fragment
+from assets import init_assets
+from bulk import BulkActionError, bulk_update_products
+from catalog import current_version, load_changes, stamp_unversioned
+from ratelimit import RouteLimiter
+from idempotency import IdempotencyStore, IN_FLIGHT
+from outbox import OutboxWorker, enqueue, purge_processed
+from routing import enable_wal, read_session
+from carts import add_to_guest_cart, remove_from_guest_cart, load_cart_items, load_guest_cart_items, merge_guest_cart, purge_abandoned_carts, stamp_untimed_carts
+from sharding import ShardRouter
+from allocations import reconcile_stock, release_unsold_stock, take_stock
+from archive import archive_orders, load_order_page, reserve_archived_ids
+from compression import CompressionMiddleware, CompressionStats, ROUTE_KEY
+from profiling import QueryProfiler
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
-from typing import Optional, List
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session, scoped_session, sessionmaker, joinedload
+from typing import Optional, List, Dict, Hashable, Iterator, Tuple
+import uuid
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import create_engine, insert, inspect
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
 from functools import wraps
 import logging
-from datetime import datetime
+import sys
+from datetime import datetime, timedelta
 # Divide classes using "MVC standard"
 # Design pattern use Strategy
 # Use JWT token for authentication
@@ -25,6 +45,48 @@ logging.basicConfig(level=logging.DEBUG)
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'test' ### TIRAR
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///ecommerce.db'
+# Read-only handlers use this database, a replica URL can be set here later
+app.config['SQLALCHEMY_READ_DATABASE_URI'] = 'sqlite:///file:ecommerce.db?mode=ro&uri=true'
+app.config['DB_WRITER_POOL_SIZE'] = 2
+app.config['DB_READER_POOL_SIZE'] = 8
+# Connections a pool may open beyond its size; 0 keeps the pools at their sizes, so requests
+# wait for a connection rather than pile more connections onto SQLite
+app.config['DB_MAX_OVERFLOW'] = 0
+# Carts and orders are spread over these databases by user id; empty keeps them in the main one
+app.config['SHARD_DATABASE_URIS'] = []
+app.config['SHARD_POOL_SIZE'] = 2
+# Units of a product a shard takes from the catalog at once; sharded checkouts only write
+# to the catalog when their shard runs out
+app.config['STOCK_ALLOCATION_CHUNK'] = 20
+app.config['JINJA_BYTECODE_CACHE_DIR'] = None  # None uses the system temp directory
+app.config['FRAGMENT_CACHE_SIZE'] = 64
+app.config['LISTING_CHUNK_SIZE'] = 500
+app.config['LISTING_STREAM_THRESHOLD'] = 200  # Listings with more rows are streamed
+app.config['COMPRESSION_MIN_SIZE'] = 500  # Smaller bodies are sent uncompressed
+app.config['COMPRESSION_LEVELS'] = {'gzip': 6, 'br': 4, 'zstd': 3}
+app.config['IDEMPOTENCY_TTL'] = 24 * 60 * 60  # Seconds a checkout key is remembered
+app.config['IDEMPOTENCY_MAX_KEYS'] = 10000
+app.config['OUTBOX_WORKERS'] = 2
+app.config['OUTBOX_BATCH_SIZE'] = 50
+app.config['OUTBOX_MAX_ATTEMPTS'] = 5
+app.config['OUTBOX_RETENTION_DAYS'] = 7  # Handled events older than this are purged
+app.config['LOW_STOCK_THRESHOLD'] = 5
+app.config['ABANDONED_CART_DAYS'] = 30  # Persistent carts untouched this long are purged
+app.config['ORDER_ARCHIVE_DAYS'] = 365  # Older orders are moved to the archive tables
+app.config['ORDERS_PAGE_SIZE'] = 20
+app.config['CATALOG_CHANGES_PAGE_SIZE'] = 100
+app.config['CATALOG_CHANGES_MAX_PAGE_SIZE'] = 1000
+# Log every request's statements with their query plans, flagging scans, repeats and slow ones
+app.config['SQL_PROFILING'] = False
+app.config['SQL_SLOW_QUERY_MS'] = 100
+# Reverse proxies in front of the app, whose X-Forwarded-* headers are trusted for the client
+# IP; leave at 0 when clients connect directly, or anyone could spoof their IP
+app.config['TRUSTED_PROXY_COUNT'] = 0
+# Requests per second and burst per user and per IP, and requests in flight per route class
+app.config['RATE_LIMITS'] = {
+    'login': {'rate': 0.5, 'burst': 5, 'concurrency': 4},
+    'checkout': {'rate': 1.0, 'burst': 5, 'concurrency': 2},
+}
 
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -33,11 +95,117 @@ login_manager.login_view = 'login'
 # Setup the JWT manager
 jwt = JWTManager(app)
 
-# Initialize the database
-app.engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+# Initialize the database: a small writer pool and a separate read-only pool
+app.engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'], pool_size=app.config['DB_WRITER_POOL_SIZE'],
+                           max_overflow=app.config['DB_MAX_OVERFLOW'])
+enable_wal(app.engine)
 session_factory = sessionmaker(bind=app.engine)
 app.SessionLocal = scoped_session(session_factory)
-Base.metadata.create_all(bind=app.engine)
+# Only a new database gets its tables here; existing ones are upgraded with `flask upgrade-db`
+if not inspect(app.engine).get_table_names():
+    Base.metadata.create_all(bind=app.engine)
+app.read_engine = create_engine(app.config['SQLALCHEMY_READ_DATABASE_URI'], pool_size=app.config['DB_READER_POOL_SIZE'],
+                                max_overflow=app.config['DB_MAX_OVERFLOW'])
+app.ReadSessionLocal = scoped_session(sessionmaker(bind=app.read_engine))
+app.shards = ShardRouter(app.config['SHARD_DATABASE_URIS'], app.config['SHARD_POOL_SIZE'], app.config['DB_MAX_OVERFLOW'])
+
+# Refuse to start on databases older than the code, rather than fail the requests touching
+# what they lack; `flask upgrade-db` itself runs on them
+if 'upgrade-db' not in sys.argv[1:]:
+    schema_gaps: List[str] = missing_schema(app.engine, Base.metadata) + app.shards.missing_schema()
+    if schema_gaps:
+        raise RuntimeError(f"The database schema is behind the code, run `flask upgrade-db` first. "
+                           f"Missing: {', '.join(schema_gaps)}")
+
+# SQL profiling, enabled per request by SQL_PROFILING
+app.query_profiler = QueryProfiler(app.config['SQL_SLOW_QUERY_MS'])
+for profiled_engine in [app.engine, app.read_engine] + app.shards.engines:
+    app.query_profiler.instrument(profiled_engine)
+
+# Template caching: compiled templates survive worker restarts, rendered listings survive requests
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_BYTECODE_CACHE_DIR'])
+app.fragment_cache = FragmentCache(app.config['FRAGMENT_CACHE_SIZE'])
+
+# Fingerprinted static assets (built with `python assets.py`)
+init_assets(app)
+
+# Compress dynamic responses
+app.compression_stats = CompressionStats()
+app.wsgi_app = CompressionMiddleware(app.wsgi_app, min_size=app.config['COMPRESSION_MIN_SIZE'],
+                                     levels=app.config['COMPRESSION_LEVELS'], stats=app.compression_stats)
+
+# Client IPs behind reverse proxies, for the rate limits
+if app.config['TRUSTED_PROXY_COUNT']:
+    proxies: int = app.config['TRUSTED_PROXY_COUNT']
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies, x_host=proxies)
+
+# Admission control for the expensive routes
+app.rate_limiters = {name: RouteLimiter(**limits) for name, limits in app.config['RATE_LIMITS'].items()}
+
+# Checkout request keys, so retries replay the first result
+app.idempotency_store = IdempotencyStore(app.config['IDEMPOTENCY_TTL'], app.config['IDEMPOTENCY_MAX_KEYS'])
+
+# Background handling of post-checkout work
+# Events live with the orders, so the workers drain every shard; unsharded, the router
+# finds the catalog through `current_app`, so the worker threads run in an app context
+app.outbox_worker = OutboxWorker(lambda shard: app.shards.session_for_shard(shard), shards=app.shards.count,
+                                 threads=app.config['OUTBOX_WORKERS'], batch_size=app.config['OUTBOX_BATCH_SIZE'],
+                                 max_attempts=app.config['OUTBOX_MAX_ATTEMPTS'], context_factory=app.app_context)
+
+@app.outbox_worker.handler('order_placed')
+def alert_low_stock(db: Session, payload: dict) -> None:
+    """
+    Warn about products an order left at or below the low-stock threshold.
+    """
+    for product_id, stock in payload['stock_levels'].items():
+        if stock <= app.config['LOW_STOCK_THRESHOLD']:
+            logging.warning(f"Low stock: product {product_id} has {stock} left")
+
+@app.outbox_worker.handler('order_placed')
+def reconcile_shard_stock(db: Session, payload: dict) -> None:
+    """
+    Take the stock a sharded order sold out of the catalog's products.
+    """
+    if payload.get('shard') is None:
+        return
+    catalog: Session = app.SessionLocal()
+    try:
+        reconcile_stock(catalog, db, payload['shard'], payload['product_ids'])
+    finally:
+        catalog.close()
+
+@app.before_request
+def start_outbox_worker():
+    """
+    Start the outbox workers on the first request, after any server fork.
+    """
+    if not app.testing:
+        app.outbox_worker.start()
+
+@app.before_request
+def tag_compression_route():
+    """
+    Let the compression middleware aggregate its metrics per endpoint.
+    """
+    request.environ[ROUTE_KEY] = request.endpoint or request.path
+
+@app.before_request
+def start_query_profile():
+    """
+    Collect the request's SQL statements when profiling is on.
+    """
+    if app.config['SQL_PROFILING']:
+        g._query_records = app.query_profiler.begin()
+
+@app.teardown_request
+def report_query_profile(error: Optional[BaseException]) -> None:
+    """
+    Report the request's SQL statements once it is done, streamed bodies included.
+    """
+    records = g.pop('_query_records', None)
+    if records is not None:
+        app.query_profiler.end(records)
+        app.query_profiler.report(request.endpoint or request.path, records)
 
 @app.context_processor
 def inject_current_year():
@@ -49,7 +217,7 @@ def load_user(user_id: int) -> Optional[User]:
     """
     Load a user from the database by ID.
     """
-    db: Session = app.SessionLocal()
+    db: Session = read_session()
     user = db.get(User, int(user_id))
     db.close()
     return user
@@ -66,15 +234,74 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def iter_products() -> Iterator[Product]:
+    """
+    Yield all products in chunks, closing the session once the last one is read.
+    """
+    db: Session = read_session()
+    try:
+        yield from db.query(Product).order_by(Product.id).yield_per(app.config['LISTING_CHUNK_SIZE'])
+    finally:
+        db.close()
+
+def render_listing(template_name: str, fragment_name: str):
+    """
+    Render a page embedding a product listing fragment.
+
+    A cached fragment for the current catalog version is rendered in place. Otherwise
+    the fragment is rendered and stored in the cache, and listings that were large
+    last time they were rendered are streamed so the first byte leaves before the
+    last row is rendered.
+    """
+    db: Session = read_session()
+    key: Hashable = (fragment_name, current_version(db))
+    db.close()
+    listing = app.fragment_cache.get(key)
+    if listing is not None:
+        return render_template(template_name, listing=[listing])
+    listing = render_fragment(app.fragment_cache, key, fragment_name, iter_products)
+    if app.fragment_cache.row_counts.get(fragment_name, 0) <= app.config['LISTING_STREAM_THRESHOLD']:
+        return render_template(template_name, listing=listing)
+    # Pop flashed messages now, the session cookie is sent before the body is streamed
+    get_flashed_messages()
+    return stream_template(template_name, listing=listing)
+
+def rate_limited(route_class: str, methods: tuple = ('GET', 'POST')):
+    """
+    Decorator to shed requests over the route class's rate or concurrency limits.
+
+    Requests are keyed by client IP and by user: the logged in user, or the username
+    being logged in to combined with the IP, so one client cannot lock another out of
+    their account. Rejected requests get a 429 with a Retry-After header.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method not in methods:
+                return f(*args, **kwargs)
+            keys: List[str] = [f'ip:{request.remote_addr}']
+            if current_user.is_authenticated:
+                keys.append(f'user:{current_user.id}')
+            elif request.form.get('username'):
+                keys.append(f"username:{request.form['username']}@{request.remote_addr}")
+            limiter: RouteLimiter = app.rate_limiters[route_class]
+            retry_after: int = limiter.admit(keys)
+            if retry_after:
+                logging.warning(f"Rate limited {route_class} request from {keys}")
+                return render_template('429.html'), 429, {'Retry-After': str(retry_after)}
+            try:
+                return f(*args, **kwargs)
+            finally:
+                limiter.release()
+        return decorated_function
+    return decorator
+
 @app.route('/')
 def index():
     """
     Home page showing list of products.
     """
-    db: Session = app.SessionLocal()
-    products: List[Product] = db.query(Product).all()
-    db.close()
-    return render_template('index.html', products=products)
+    return render_listing('index.html', '_product_list.html')
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -118,6 +345,7 @@ def register():
 
 
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limited('login', methods=('POST',))
 def login():
     """
     Log in an existing user.
@@ -126,11 +354,26 @@ def login():
         logging.debug(f"Form data login: {request.form}")
         username: str = request.form['username']
         password: str = request.form['password']
-        db: Session = app.SessionLocal()
+        db: Session = read_session()
         user: Optional[User] = db.query(User).filter_by(username=username).first()
         db.close()
         if user and check_password_hash(user.password_hash, password):
             login_user(user)
+            catalog: Session = app.SessionLocal()
+            db = app.shards.session(user.id)
+            try:
+                merged: int = merge_guest_cart(catalog, db, user.id)
+            except SQLAlchemyError:
+                # The guest cart stays in the session and is merged at the next login
+                logging.exception(f"Could not merge the guest cart of user {user.id}")
+                db.rollback()
+                merged = 0
+                flash('Your cart could not be restored right now, please log in again later to restore it.')
+            finally:
+                db.close()
+                catalog.close()
+            if merged:
+                return redirect(url_for('view_cart'))
             return redirect(url_for('index'))
         else:
             flash('Invalid username or password.')
@@ -154,10 +397,7 @@ def admin_products():
     """
     Admin view to list all products.
     """
-    db: Session = app.SessionLocal()
-    products: List[Product] = db.query(Product).all()
-    db.close()
-    return render_template('admin_products.html', products=products)
+    return render_listing('admin_products.html', '_admin_product_rows.html')
 
 @app.route('/admin/products/add', methods=['GET', 'POST'])
 @login_required
@@ -225,32 +465,79 @@ def delete_product(product_id: int):
     db.close()
     return redirect(url_for('admin_products'))
 
+@app.route('/admin/products/bulk', methods=['POST'])
+@login_required
+@admin_required
+def bulk_products():
+    """
+    Admin view to reprice, restock or delete many products in one transaction.
+    """
+    logging.debug(f"Form data bulk products: {request.form}")
+    try:
+        value: Optional[float] = float(request.form['value']) if request.form.get('value') else None
+        max_stock: Optional[int] = int(request.form['max_stock']) if request.form.get('max_stock') else None
+        product_ids: List[int] = [int(product_id) for product_id in request.form.getlist('product_ids')]
+    except ValueError:
+        flash('Invalid bulk action input.')
+        return redirect(url_for('admin_products'))
+    db: Session = app.SessionLocal()
+    cart_sessions: List[Session] = app.shards.all_sessions()
+    try:
+        affected: int = bulk_update_products(db, request.form.get('action', ''), value=value,
+                                             product_ids=product_ids,
+                                             name_contains=request.form.get('name_contains') or None,
+                                             max_stock=max_stock, cart_sessions=cart_sessions)
+    except BulkActionError as error:
+        flash(str(error))
+        return redirect(url_for('admin_products'))
+    finally:
+        for cart_db in cart_sessions:
+            cart_db.close()
+        db.close()
+    flash(f'{affected} products affected.')
+    return redirect(url_for('admin_products'))
+
 # User routes for cart and order management
 
 @app.route('/cart')
-@login_required
 def view_cart():
     """
-    View the current user's cart.
+    View the current user's cart, or the guest cart kept in the session.
     """
-    db: Session = app.SessionLocal()
-    cart_items = db.query(CartItem).options(joinedload(CartItem.product)).filter_by(user_id=current_user.id).all()
-    # cart_items: List[CartItem] = db.query(CartItem).filter_by(user_id=current_user.id).all()
-    db.close()
-    return render_template('cart.html', cart_items=cart_items)
+    catalog: Session = read_session()
+    if current_user.is_authenticated:
+        db: Session = app.shards.read_session(current_user.id)
+        cart_items = load_cart_items(catalog, db, current_user.id)
+        db.close()
+    else:
+        cart_items = load_guest_cart_items(catalog)
+    catalog.close()
+    return render_template('cart.html', cart_items=cart_items, idempotency_key=uuid.uuid4().hex)
 
 @app.route('/cart/add/<int:product_id>')
-@login_required
 def add_to_cart(product_id: int):
     """
-    Add a product to the current user's cart.
+    Add a product to the current user's cart, or to the guest cart without touching the database.
     """
-    db: Session = app.SessionLocal()
-    product: Optional[Product] = db.get(Product, product_id)
-    if not product:
+    if not current_user.is_authenticated:
+        db: Session = read_session()
+        product: Optional[Product] = db.get(Product, product_id)
         db.close()
+        if not product:
+            flash('Product not found.')
+            return redirect(url_for('index'))
+        if not add_to_guest_cart(product_id):
+            flash('Your cart is full. Log in to add more products.')
+            return redirect(url_for('view_cart'))
+        flash('Product added to cart.')
+        return redirect(url_for('view_cart'))
+    catalog: Session = read_session()
+    product: Optional[Product] = catalog.get(Product, product_id)
+    catalog.close()
+    if not product:
         flash('Product not found.')
         return redirect(url_for('index'))
+    db: Session = app.shards.session(current_user.id)
     existing_item: Optional[CartItem] = db.query(CartItem).filter_by(user_id=current_user.id, product_id=product_id).first()
     if existing_item:
         existing_item.quantity += 1
@@ -263,12 +550,17 @@ def add_to_cart(product_id: int):
     return redirect(url_for('view_cart'))
 
 @app.route('/cart/remove/<int:item_id>')
-@login_required
 def remove_from_cart(item_id: int):
     """
-    Remove an item from the current user's cart.
+    Remove an item from the current user's cart, or a product from the guest cart.
     """
-    db: Session = app.SessionLocal()
+    if not current_user.is_authenticated:
+        if remove_from_guest_cart(item_id):
+            flash('Item removed from cart.')
+        else:
+            flash('Item not found in your cart.')
+        return redirect(url_for('view_cart'))
+    db: Session = app.shards.session(current_user.id)
     cart_item: Optional[CartItem] = db.get(CartItem, item_id)
     if cart_item and cart_item.user_id == current_user.id:
         db.delete(cart_item)
@@ -283,49 +575,267 @@ def remove_from_cart(item_id: int):
 @login_required
 def view_orders():
     """
-    View the current user's orders.
+    View the current user's orders, one page at a time; `archived=1` pages through the
+    orders moved to the archive.
     """
-    db: Session = app.SessionLocal()
-    orders: List[Order] = db.query(Order).options(
-        joinedload(Order.items).joinedload(OrderItem.product)
-    ).filter_by(user_id=current_user.id).all()
+    page: int = max(1, request.args.get('page', 1, type=int))
+    archived: bool = request.args.get('archived') == '1'
+    db: Session = app.shards.read_session(current_user.id)
+    orders, has_next = load_order_page(db, current_user.id, page, app.config['ORDERS_PAGE_SIZE'], archived)
     db.close()
-    return render_template('orders.html', orders=orders)
-
+    # Items carry their product's name, only orders placed before that need the catalog
+    products: Dict[int, Product] = {}
+    product_ids = {item.product_id for order in orders for item in order.items if item.product_name is None}
+    if product_ids:
+        catalog: Session = read_session()
+        products = {product.id: product for product in catalog.query(Product).filter(Product.id.in_(product_ids))}
+        catalog.close()
+    return render_template('orders.html', orders=orders, products=products, page=page, has_next=has_next,
+                           archived=archived)
+
+
+def checkout(user_id: int, idempotency_key: Optional[str] = None) -> Tuple[bool, str, str]:
+    """
+    Turn a user's cart into an order.
+
+    Unsharded, the stock, the order and the cart change in one transaction. Sharded,
+    the user's shard sells from the stock the catalog allocated to it, so the order,
+    the cart and the shard's stock totals change in one shard transaction and the
+    catalog is only written when the shard needs another allocation. The outbox
+    takes the sold units out of the catalog's stock afterwards.
+
+    An idempotency key is stored with the order, unique per user, so a retry reaching
+    any worker, even after a restart, finds the order instead of placing another.
+
+    Returns whether the order was placed, the message to flash and the endpoint to
+    redirect to.
+    """
+    catalog: Session = app.SessionLocal()
+    db: Session = app.shards.session(user_id)
+    sharded: bool = db is not catalog
+    try:
+        if idempotency_key and db.query(Order.id).filter_by(
+                user_id=user_id, idempotency_key=idempotency_key).first() is not None:
+            return True, 'Order placed successfully.', 'view_orders'
+        cart_items: List[CartItem] = db.query(CartItem).filter_by(user_id=user_id).all()
+        if not cart_items:
+            return False, 'Your cart is empty.', 'index'
+        products: Dict[int, Product] = {product.id: product for product in catalog.query(Product).filter(
+            Product.id.in_({item.product_id for item in cart_items}))}
+        total_price: float = 0.0
+        order_items: List[Dict] = []
+        quantities: Dict[int, int] = {}
+        for item in cart_items:
+            product: Optional[Product] = products.get(item.product_id)
+            if product is None:
+                catalog.rollback()
+                return False, 'A product in your cart is no longer available.', 'view_cart'
+            if not sharded:
+                if product.stock < item.quantity:
+                    catalog.rollback()
+                    return False, f'Product {product.name} is out of stock or insufficient quantity.', 'view_cart'
+                product.stock -= item.quantity
+            total_price += product.price * item.quantity
+            order_items.append({'product_id': product.id, 'product_name': product.name, 'quantity': item.quantity})
+            quantities[product.id] = quantities.get(product.id, 0) + item.quantity
+        stock_levels: Dict[int, int] = {product.id: product.stock for product in products.values()}
+        shard: Optional[int] = None
+        if sharded:
+            # The catalog only learns of the sale from the outbox, these are the levels it will reach
+            stock_levels = {product_id: stock - quantities[product_id] for product_id, stock in stock_levels.items()}
+            names: Dict[int, str] = {product.id: product.name for product in products.values()}
+            shard = app.shards.shard_of(user_id)
+            short: Optional[int] = take_stock(catalog, db, shard, quantities, app.config['STOCK_ALLOCATION_CHUNK'],
+                                              app.shards.count)
+            if short is not None:
+                db.rollback()
+                return False, f'Product {names[short]} is out of stock or insufficient quantity.', 'view_cart'
+        new_order = Order(user_id=user_id, total_price=total_price, idempotency_key=idempotency_key)
+        db.add(new_order)
+        try:
+            db.flush()
+        except IntegrityError:
+            # A concurrent request with the same key placed the order first
+            db.rollback()
+            catalog.rollback()
+            return True, 'Order placed successfully.', 'view_orders'
+        # One executemany, the ORM would insert items one by one to read back their ids
+        db.execute(insert(OrderItem), [dict(order_item, order_id=new_order.id) for order_item in order_items])
+        # Follow-up work is committed with the order and handled by the outbox workers
+        enqueue(db, 'order_placed', {
+            'order_id': new_order.id,
+            'user_id': user_id,
+            'stock_levels': stock_levels,
+            'shard': shard,
+            'product_ids': list(quantities),
+        })
+        # Clear cart
+        db.query(CartItem).filter_by(user_id=user_id).delete()
+        db.commit()
+    finally:
+        db.close()
+        catalog.close()
+    return True, 'Order placed successfully.', 'view_orders'
 
-@app.route('/order/place')
+@app.route('/order/place', methods=['POST'])
 @login_required
+@rate_limited('checkout')
 def place_order():
     """
     Place an order with the items in the current user's cart.
+
+    A request carrying an idempotency key (the form field or the Idempotency-Key
+    header) checks out at most once; retries with the same key replay the first result.
+    Keys are remembered in memory as a fast path and with the order as the guarantee,
+    so keys longer than the order stores are rejected.
+    """
+    request_key: Optional[str] = request.form.get('idempotency_key') or request.headers.get('Idempotency-Key')
+    if not request_key:
+        placed, message, endpoint = checkout(current_user.id)
+        flash(message)
+        return redirect(url_for(endpoint))
+    if len(request_key) > Order.idempotency_key.type.length:
+        abort(400)
+    key = (current_user.id, request_key)
+    existing = app.idempotency_store.begin(key)
+    if existing is not None:
+        state, result = existing
+        if state == IN_FLIGHT:
+            flash('Your order is already being processed.')
+            return redirect(url_for('view_orders'))
+        message, endpoint = result
+        flash(message)
+        return redirect(url_for(endpoint))
+    try:
+        placed, message, endpoint = checkout(current_user.id, request_key)
+    except Exception:
+        app.idempotency_store.abandon(key)
+        raise
+    if placed:
+        app.idempotency_store.complete(key, (message, endpoint))
+    else:
+        # Let the user fix the cart and retry with the same form
+        app.idempotency_store.abandon(key)
+    flash(message)
+    return redirect(url_for(endpoint))
+
+@app.route('/catalog/changes')
+def catalog_changes():
+    """
+    Feed of the products changed or deleted after catalog version `since`, for clients
+    and caches that mirror the catalog. Pass the returned `since` and `after_id` to get
+    the next page.
+    """
+    try:
+        since: int = int(request.args.get('since', 0))
+        after_id: Optional[int] = int(request.args['after_id']) if request.args.get('after_id') else None
+        limit: int = int(request.args.get('limit', app.config['CATALOG_CHANGES_PAGE_SIZE']))
+    except ValueError:
+        abort(400)
+    if since < 0 or limit < 1:
+        abort(400)
+    db: Session = read_session()
+    changes, next_since, next_after_id, has_more = load_changes(
+        db, since, min(limit, app.config['CATALOG_CHANGES_MAX_PAGE_SIZE']), after_id)
+    db.close()
+    return jsonify({'changes': changes, 'since': next_since, 'after_id': next_after_id, 'has_more': has_more})
+
+@app.route('/admin/metrics/compression')
+@login_required
+@admin_required
+def compression_metrics():
     """
-    db: Session = app.SessionLocal()
-    cart_items: List[CartItem] = db.query(CartItem).filter_by(user_id=current_user.id).all()
-    if not cart_items:
+    Admin view of the compression ratio and CPU time spent per route.
+    """
+    return jsonify(app.compression_stats.snapshot())
+
+@app.route('/admin/metrics/outbox')
+@login_required
+@admin_required
+def outbox_metrics():
+    """
+    Admin view of the outbox queue depth and lag.
+    """
+    return jsonify(app.outbox_worker.metrics())
+
+@app.route('/admin/metrics/queries')
+@login_required
+@admin_required
+def query_metrics():
+    """
+    Admin view of the SQL profiles of the latest requests, when SQL_PROFILING is on.
+    """
+    return jsonify(list(app.query_profiler.reports))
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """
+    Add the columns and indexes existing databases lack, run once per deploy before
+    the workers start.
+    """
+    upgrade_schema(app.engine, Base.metadata)
+    app.shards.upgrade_schema()
+    timed: int = 0
+    for db in app.shards.all_sessions():
+        reserve_archived_ids(db)
+        timed += stamp_untimed_carts(db)
         db.close()
-        flash('Your cart is empty.')
-        return redirect(url_for('index'))
-    total_price: float = 0.0
-    order_items: List[OrderItem] = []
-    for item in cart_items:
-        product: Optional[Product] = db.get(Product, item.product_id)
-        if product and product.stock >= item.quantity:
-            product.stock -= item.quantity
-            total_price += product.price * item.quantity
-            order_item = OrderItem(product_id=product.id, quantity=item.quantity)
-            order_items.append(order_item)
-        else:
-            db.close()
-            flash(f'Product {product.name} is out of stock or insufficient quantity.')
-            return redirect(url_for('view_cart'))
-    new_order = Order(user_id=current_user.id, total_price=total_price, items=order_items)
-    db.add(new_order)
-    # Clear cart
-    db.query(CartItem).filter_by(user_id=current_user.id).delete()
-    db.commit()
+    db: Session = app.SessionLocal()
+    stamped: int = stamp_unversioned(db)
     db.close()
-    flash('Order placed successfully.')
-    return redirect(url_for('view_orders'))
+    print(f'Database upgraded, {stamped} products versioned and {timed} cart items timestamped.')
+
+@app.cli.command('purge-carts')
+def purge_carts_command():
+    """
+    Delete persistent carts untouched for ABANDONED_CART_DAYS, run periodically from cron.
+    """
+    deleted: int = 0
+    for db in app.shards.all_sessions():
+        deleted += purge_abandoned_carts(db, utcnow() - timedelta(days=app.config['ABANDONED_CART_DAYS']))
+        db.close()
+    print(f'Purged {deleted} abandoned cart items.')
+
+@app.cli.command('settle-stock')
+def settle_stock_command():
+    """
+    Reconcile the stock sold by every shard into the catalog and hand back the unsold
+    allocations of products running out, run periodically from cron.
+    """
+    if not app.shards.urls:
+        print('Carts and orders are not sharded, there is no stock to settle.')
+        return
+    catalog: Session = app.SessionLocal()
+    released: int = 0
+    for shard, db in enumerate(app.shards.all_sessions()):
+        reconcile_stock(catalog, db, shard)
+        released += release_unsold_stock(catalog, db, shard, app.config['STOCK_ALLOCATION_CHUNK'])
+        reconcile_stock(catalog, db, shard)
+        db.close()
+    catalog.close()
+    print(f'Released the unsold stock of {released} shard allocations.')
+
+@app.cli.command('purge-outbox')
+def purge_outbox_command():
+    """
+    Delete outbox events handled more than OUTBOX_RETENTION_DAYS ago, run periodically from cron.
+    """
+    deleted: int = 0
+    for db in app.shards.all_sessions():
+        deleted += purge_processed(db, utcnow() - timedelta(days=app.config['OUTBOX_RETENTION_DAYS']))
+        db.close()
+    print(f'Purged {deleted} processed outbox events.')
+
+@app.cli.command('archive-orders')
+def archive_orders_command():
+    """
+    Move orders older than ORDER_ARCHIVE_DAYS to the archive tables, run periodically from cron.
+    """
+    archived: int = 0
+    for db in app.shards.all_sessions():
+        archived += archive_orders(db, utcnow() - timedelta(days=app.config['ORDER_ARCHIVE_DAYS']))
+        db.close()
+    print(f'Archived {archived} orders.')
 
 # Error handling
 
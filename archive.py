@@ -0,0 +1,80 @@
+# archive.py
+
+"""
+This module moves old orders out of the hot tables and pages through both.
+"""
+
+from datetime import datetime
+from typing import List, Tuple, Union
+from sqlalchemy import func, insert, select, text
+from sqlalchemy.orm import Session, joinedload
+from models import Order, OrderItem, ArchivedOrder, ArchivedOrderItem
+
+AnyOrder = Union[Order, ArchivedOrder]
+
+def archive_orders(db: Session, older_than: datetime, chunk_size: int = 500) -> int:
+    """
+    Move orders placed before `older_than`, and their items, to the archive tables.
+
+    Each chunk is copied and deleted in its own transaction, so the write lock is
+    only held briefly.
+
+    Returns the number of orders archived.
+    """
+    archived = 0
+    while True:
+        ids: List[int] = [order_id for (order_id,) in db.query(Order.id).filter(
+            Order.timestamp < older_than).order_by(Order.id).limit(chunk_size)]
+        if not ids:
+            return archived
+        db.execute(insert(ArchivedOrder).from_select(
+            ['id', 'user_id', 'timestamp', 'total_price'],
+            select(Order.id, Order.user_id, Order.timestamp, Order.total_price).where(Order.id.in_(ids))))
+        db.execute(insert(ArchivedOrderItem).from_select(
+            ['id', 'order_id', 'product_id', 'product_name', 'quantity'],
+            select(OrderItem.id, OrderItem.order_id, OrderItem.product_id, OrderItem.product_name, OrderItem.quantity)
+            .where(OrderItem.order_id.in_(ids))))
+        db.query(OrderItem).filter(OrderItem.order_id.in_(ids)).delete(synchronize_session=False)
+        db.query(Order).filter(Order.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        archived += len(ids)
+
+def reserve_archived_ids(db: Session) -> None:
+    """
+    Make the hot tables hand out ids above every archived one.
+
+    Needed once for databases whose hot tables predate AUTOINCREMENT, where ids of
+    archived rows could otherwise be handed out again.
+    """
+    for hot, archived in ((Order, ArchivedOrder), (OrderItem, ArchivedOrderItem)):
+        top = db.scalar(select(func.max(archived.id)))
+        if top is None:
+            continue
+        sequence = db.execute(text('SELECT seq FROM sqlite_sequence WHERE name = :name'),
+                              {'name': hot.__tablename__}).scalar()
+        if sequence is None:
+            db.execute(text('INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)'),
+                       {'name': hot.__tablename__, 'seq': top})
+        elif sequence < top:
+            db.execute(text('UPDATE sqlite_sequence SET seq = :seq WHERE name = :name'),
+                       {'name': hot.__tablename__, 'seq': top})
+    db.commit()
+
+def _page_query(db: Session, model, user_id: int):
+    return db.query(model).options(joinedload(model.items)).filter(
+        model.user_id == user_id).order_by(model.timestamp.desc(), model.id.desc())
+
+def load_order_page(db: Session, user_id: int, page: int, page_size: int,
+                    archived: bool = False) -> Tuple[List[AnyOrder], bool]:
+    """
+    Load one page of a user's orders, newest first, from the hot tables or the archive.
+
+    The archive is paged on its own, after the last page of hot orders, so the pages
+    of recent orders never read it. Items are loaded with their order in the same
+    statement, and carry the name their product had when ordered.
+
+    Returns the orders of the page and whether a next page exists.
+    """
+    orders: List[AnyOrder] = _page_query(db, ArchivedOrder if archived else Order, user_id).offset(
+        (page - 1) * page_size).limit(page_size + 1).all()
+    return orders[:page_size], len(orders) > page_size
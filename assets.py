@@ -0,0 +1,128 @@
+# assets.py
+
+"""
+This module builds and serves fingerprinted, precompressed static assets.
+
+Run `python assets.py` after changing anything in `static/`. Each file is copied to
+`static/dist/` under a content-hashed name, alongside gzip (and brotli, when the
+`brotli` package is installed) variants and a `manifest.json` mapping source names
+to hashed names.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+from typing import Dict, Optional
+from flask import Flask, Response, current_app, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip variants are always built
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Content-Encoding token and file suffix, in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+def fingerprint(path: str, length: int = 10) -> str:
+    """
+    Return a short content hash of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()[:length]
+
+def build_assets(static_folder: str) -> Dict[str, str]:
+    """
+    Fingerprint and precompress every file in the static folder.
+
+    Returns the manifest mapping source names to fingerprinted names.
+    """
+    dist_folder = os.path.join(static_folder, DIST_DIR)
+    if os.path.isdir(dist_folder):
+        shutil.rmtree(dist_folder)
+    os.makedirs(dist_folder)
+    manifest: Dict[str, str] = {}
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != dist_folder]
+        for name in sorted(files):
+            source = os.path.join(root, name)
+            filename = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            stem, ext = os.path.splitext(filename)
+            hashed = f'{stem}.{fingerprint(source)}{ext}'
+            target = os.path.join(dist_folder, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(source, target)
+            with open(source, 'rb') as f:
+                data = f.read()
+            with open(target + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                with open(target + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, quality=11))
+            manifest[filename] = hashed
+    with open(os.path.join(dist_folder, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+def load_manifest(static_folder: str) -> Dict[str, str]:
+    """
+    Load the asset manifest, or an empty one if the assets were never built.
+    """
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def asset_url(filename: str) -> str:
+    """
+    Return the URL of the fingerprinted asset, falling back to the plain static file.
+    """
+    hashed: Optional[str] = current_app.asset_manifest.get(filename)
+    if hashed is None:
+        return url_for('static', filename=filename)
+    return url_for('static', filename=f'{DIST_DIR}/{hashed}')
+
+def serve_static(filename: str) -> Response:
+    """
+    Serve a static file, with immutable caching and precompressed variants for built assets.
+    """
+    if not filename.startswith(DIST_DIR + '/'):
+        return current_app.send_static_file(filename)
+    dist_folder = os.path.join(current_app.static_folder, DIST_DIR)
+    path = filename[len(DIST_DIR) + 1:]
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    encoding: Optional[str] = None
+    for token, suffix in ENCODINGS:
+        if request.accept_encodings[token] and os.path.isfile(os.path.join(dist_folder, path + suffix)):
+            encoding, path = token, path + suffix
+            break
+    response = send_from_directory(dist_folder, path, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    if encoding is not None:
+        response.content_encoding = encoding
+    return response
+
+def init_assets(app: Flask) -> None:
+    """
+    Load the manifest and register the asset helpers on the app.
+    """
+    app.asset_manifest = load_manifest(app.static_folder)
+    app.jinja_env.globals['asset_url'] = asset_url
+    app.view_functions['static'] = serve_static
+
+if __name__ == '__main__':
+    static_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    for source, hashed in build_assets(static_folder).items():
+        print(f'{source} -> {DIST_DIR}/{hashed}')
@@ -0,0 +1,116 @@
+# benchmark_routing.py
+
+"""
+Benchmark read throughput while checkouts run, with reads sharing the writer pool
+versus reads routed to the read-only pool.
+
+Usage: python benchmark_routing.py [--seconds 3] [--readers 1 2 4 8]
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+from typing import List
+from sqlalchemy import create_engine
+from sqlalchemy.orm import joinedload, scoped_session, sessionmaker
+from app import app, checkout
+from models import Base, User, Product, CartItem, Order, OrderItem
+from routing import enable_wal, read_session
+
+def seed(session_factory, users: int, products: int) -> None:
+    """
+    Fill the benchmark database with users, products and one past order per user.
+    """
+    db = session_factory()
+    db.add_all(User(username=f'user{i}', password_hash='x') for i in range(users))
+    db.add_all(Product(name=f'Product {i}', description='Benchmark product', price=1.0, stock=10 ** 9)
+               for i in range(products))
+    db.commit()
+    for user_id in range(1, users + 1):
+        db.add(Order(user_id=user_id, total_price=1.0, items=[OrderItem(product_id=1, quantity=1)]))
+    db.commit()
+    db.close()
+
+def run_checkouts(stop: threading.Event, users: int, counter: List[int]) -> None:
+    """
+    Place orders in a loop, like a steady stream of checkouts.
+    """
+    with app.app_context():
+        user_id = 0
+        while not stop.is_set():
+            user_id = user_id % users + 1
+            db = app.SessionLocal()
+            db.add(CartItem(user_id=user_id, product_id=user_id, quantity=1))
+            db.commit()
+            db.close()
+            if checkout(user_id)[0]:
+                counter[0] += 1
+        app.SessionLocal.remove()
+
+def run_reads(stop: threading.Event, users: int, counter: List[int]) -> None:
+    """
+    Load a user's orders in a loop, like the view_orders route does.
+    """
+    user_id = 0
+    while not stop.is_set():
+        user_id = user_id % users + 1
+        with app.test_request_context('/orders'):
+            db = read_session()
+            db.query(Order).options(
+                joinedload(Order.items).joinedload(OrderItem.product)
+            ).filter_by(user_id=user_id).all()
+            db.close()
+        counter[0] += 1
+    app.ReadSessionLocal.remove()
+
+def measure(readers: int, seconds: float, users: int) -> tuple:
+    """
+    Run readers and one checkout thread for a while and return (reads/s, checkouts/s).
+    """
+    stop = threading.Event()
+    reads: List[List[int]] = [[0] for _ in range(readers)]
+    checkouts = [0]
+    threads = [threading.Thread(target=run_checkouts, args=(stop, users, checkouts))]
+    threads += [threading.Thread(target=run_reads, args=(stop, users, count)) for count in reads]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return sum(count[0] for count in reads) / seconds, checkouts[0] / seconds
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--readers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--users', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        # Pools sized as the app's
+        writer = create_engine(f'sqlite:///{path}', pool_size=app.config['DB_WRITER_POOL_SIZE'],
+                               max_overflow=app.config['DB_MAX_OVERFLOW'])
+        enable_wal(writer)
+        Base.metadata.create_all(bind=writer)
+        reader = create_engine(f'sqlite:///file:{path}?mode=ro&uri=true', pool_size=app.config['DB_READER_POOL_SIZE'],
+                               max_overflow=app.config['DB_MAX_OVERFLOW'])
+        app.SessionLocal = scoped_session(sessionmaker(bind=writer))
+        seed(app.SessionLocal, args.users, args.users)
+        routed = scoped_session(sessionmaker(bind=reader))
+
+        print(f"{'readers':>8} {'shared reads/s':>15} {'routed reads/s':>15} {'checkouts/s':>12}")
+        for readers in args.readers:
+            app.ReadSessionLocal = app.SessionLocal
+            shared_reads, _ = measure(readers, args.seconds, args.users)
+            app.ReadSessionLocal = routed
+            routed_reads, checkouts = measure(readers, args.seconds, args.users)
+            print(f'{readers:>8} {shared_reads:>15.0f} {routed_reads:>15.0f} {checkouts:>12.0f}')
+        writer.dispose()
+        reader.dispose()
+
+if __name__ == '__main__':
+    main()
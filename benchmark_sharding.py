@@ -0,0 +1,137 @@
+# benchmark_sharding.py
+
+"""
+Benchmark checkout throughput with carts and orders kept in the catalog database
+versus spread over several shard databases.
+
+Checkouts run in separate processes, as under a multi-process server, so the
+layouts are limited by SQLite's write locks rather than by one interpreter lock;
+throughput can only grow with the shards while there are cores to run the
+processes. One more process runs the outbox workers throughout, so the catalog
+writes reconciling sharded stock are part of the measurement.
+
+Usage: python benchmark_sharding.py [--seconds 3] [--shards 1 2 4] [--processes 4]
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from typing import List, Sequence, Tuple
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from app import app, checkout
+from models import Base, User, Product, CartItem
+from outbox import OutboxWorker
+from routing import enable_wal
+from sharding import ShardRouter
+
+def seed(catalog_url: str, users: int, products: int) -> None:
+    """
+    Fill the catalog database with users and products.
+    """
+    engine = create_engine(catalog_url)
+    enable_wal(engine)
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add_all(User(username=f'user{i}', password_hash='x') for i in range(users))
+    db.add_all(Product(name=f'Product {i}', description='Benchmark product', price=1.0, stock=10 ** 9)
+               for i in range(products))
+    db.commit()
+    db.close()
+    engine.dispose()
+
+def use_databases(catalog_url: str, shard_urls: Sequence[str]) -> None:
+    """
+    Point the app of this process at the benchmark's catalog and shards.
+    """
+    catalog = create_engine(catalog_url, pool_size=app.config['DB_WRITER_POOL_SIZE'],
+                            max_overflow=app.config['DB_MAX_OVERFLOW'])
+    enable_wal(catalog)
+    app.SessionLocal = scoped_session(sessionmaker(bind=catalog))
+    app.shards = ShardRouter(shard_urls, app.config['SHARD_POOL_SIZE'], app.config['DB_MAX_OVERFLOW'])
+
+def run_checkouts(catalog_url: str, shard_urls: Sequence[str], user_ids: List[int], seconds: float,
+                  start, results) -> None:
+    """
+    Fill a cart and place an order in a loop, cycling through the process's users, and
+    report the checkouts placed and failed (lock timeouts, refused checkouts).
+    """
+    use_databases(catalog_url, shard_urls)
+    placed = failed = turn = 0
+    with app.app_context():
+        start.wait()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            user_id = user_ids[turn % len(user_ids)]
+            turn += 1
+            try:
+                db = app.shards.session(user_id)
+                db.add(CartItem(user_id=user_id, product_id=user_id, quantity=1))
+                db.commit()
+                db.close()
+                ok = checkout(user_id)[0]
+            except Exception:
+                ok = False
+            placed, failed = (placed + 1, failed) if ok else (placed, failed + 1)
+    results.put((placed, failed))
+
+def run_outbox(catalog_url: str, shard_urls: Sequence[str], seconds: float, start) -> None:
+    """
+    Drain the outbox of every shard until the checkouts are done.
+    """
+    use_databases(catalog_url, shard_urls)
+    worker = OutboxWorker(lambda shard: app.shards.session_for_shard(shard), shards=app.shards.count,
+                          batch_size=app.config['OUTBOX_BATCH_SIZE'], context_factory=app.app_context)
+    worker.handlers = app.outbox_worker.handlers
+    with app.app_context():
+        start.wait()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            if worker.drain_once() < worker.batch_size:
+                time.sleep(0.05)
+
+def measure(catalog_url: str, shard_urls: Sequence[str], processes: int, seconds: float,
+            users: int) -> Tuple[float, int]:
+    """
+    Run checkout processes over disjoint users for a while and return (checkouts/s, failures).
+    """
+    ShardRouter(shard_urls).dispose()  # Create the shard tables before the processes race to
+    context = multiprocessing.get_context('fork')
+    start = context.Barrier(processes + 1)
+    results = context.Queue()
+    workers = [context.Process(target=run_checkouts, args=(
+        catalog_url, shard_urls, list(range(i + 1, users + 1, processes)), seconds, start, results))
+        for i in range(processes)]
+    workers.append(context.Process(target=run_outbox, args=(catalog_url, shard_urls, seconds, start)))
+    for worker in workers:
+        worker.start()
+    counts = [results.get() for _ in range(processes)]
+    for worker in workers:
+        worker.join()
+    return sum(placed for placed, _ in counts) / seconds, sum(failed for _, failed in counts)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--users', type=int, default=64)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        catalog_url = f"sqlite:///{os.path.join(tmp, 'catalog.db')}"
+        seed(catalog_url, args.users, args.users)
+
+        print(f'{os.cpu_count()} CPUs, {args.processes} checkout processes')
+        print(f"{'layout':>10} {'checkouts/s':>12} {'failed':>8}")
+        checkouts, failed = measure(catalog_url, [], args.processes, args.seconds, args.users)
+        print(f"{'catalog':>10} {checkouts:>12.0f} {failed:>8}")
+        for count in args.shards:
+            shard_urls = [f"sqlite:///{os.path.join(tmp, f'{count}-shard{i}.db')}" for i in range(count)]
+            checkouts, failed = measure(catalog_url, shard_urls, args.processes, args.seconds, args.users)
+            print(f"{f'{count} shards':>10} {checkouts:>12.0f} {failed:>8}")
+
+if __name__ == '__main__':
+    main()
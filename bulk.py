@@ -0,0 +1,95 @@
+# bulk.py
+
+"""
+This module implements set-based bulk operations on products for the admin views.
+"""
+
+import math
+from typing import List, Optional, Sequence
+from sqlalchemy import insert
+from sqlalchemy.orm import Query, Session
+from models import Product, ProductTombstone, CartItem, utcnow
+from catalog import next_version
+
+# Stay well below SQLite's limit on bound parameters per statement
+ID_CHUNK_SIZE = 500
+
+BULK_ACTIONS = ('price_percent', 'set_stock', 'delete')
+
+class BulkActionError(ValueError):
+    """
+    Raised when a bulk operation is requested with invalid arguments.
+    """
+
+def _selections(db: Session, product_ids: Sequence[int], name_contains: Optional[str],
+                max_stock: Optional[int]) -> List[Query]:
+    """
+    Build the product queries covering a selection, one per chunk of ids.
+    """
+    query = db.query(Product)
+    if name_contains:
+        query = query.filter(Product.name.contains(name_contains, autoescape=True))
+    if max_stock is not None:
+        query = query.filter(Product.stock <= max_stock)
+    if not product_ids:
+        if not name_contains and max_stock is None:
+            raise BulkActionError('No products selected.')
+        return [query]
+    ids = sorted(set(product_ids))
+    return [query.filter(Product.id.in_(ids[i:i + ID_CHUNK_SIZE])) for i in range(0, len(ids), ID_CHUNK_SIZE)]
+
+def bulk_update_products(db: Session, action: str, value: Optional[float] = None,
+                         product_ids: Sequence[int] = (), name_contains: Optional[str] = None,
+                         max_stock: Optional[int] = None, cart_sessions: Sequence[Session] = ()) -> int:
+    """
+    Apply one bulk action to the selected products in a single transaction.
+
+    Products are selected by id, by filter, or by ids narrowed by the filter.
+    Supported actions are `price_percent` (change prices by `value` percent),
+    `set_stock` (set stock to `value`) and `delete` (delete the products and any
+    cart items referencing them). Cart items are deleted through `cart_sessions`,
+    one per cart shard, or through `db` when none are given; other shards commit
+    after the catalog. All affected products share one new catalog version.
+
+    Returns the number of products affected.
+    """
+    if action not in BULK_ACTIONS:
+        raise BulkActionError('Invalid bulk action.')
+    if action != 'delete' and value is None:
+        raise BulkActionError('A value is required for this action.')
+    if value is not None and not math.isfinite(value):
+        raise BulkActionError('The value must be a finite number.')
+    if action == 'price_percent' and value <= -100:
+        raise BulkActionError('Prices cannot drop by 100% or more.')
+    if action == 'set_stock' and (value < 0 or value != int(value)):
+        raise BulkActionError('Stock must be a non-negative whole number.')
+    selections = _selections(db, product_ids, name_contains, max_stock)
+    affected = 0
+    try:
+        version = next_version(db)
+        for selection in selections:
+            if action == 'price_percent':
+                affected += selection.update({Product.price: Product.price * (1 + value / 100),
+                                              Product.version: version}, synchronize_session=False)
+            elif action == 'set_stock':
+                affected += selection.update({Product.stock: int(value), Product.version: version},
+                                             synchronize_session=False)
+            else:
+                ids = [product_id for (product_id,) in selection.with_entities(Product.id)]
+                for i in range(0, len(ids), ID_CHUNK_SIZE):
+                    chunk = ids[i:i + ID_CHUNK_SIZE]
+                    db.execute(insert(ProductTombstone).prefix_with('OR REPLACE'), [
+                        {'product_id': product_id, 'version': version, 'deleted_at': utcnow()} for product_id in chunk])
+                    for cart_db in cart_sessions or [db]:
+                        cart_db.query(CartItem).filter(CartItem.product_id.in_(chunk)).delete(synchronize_session=False)
+                    affected += db.query(Product).filter(Product.id.in_(chunk)).delete(synchronize_session=False)
+        db.commit()
+        for cart_db in cart_sessions:
+            if cart_db is not db:
+                cart_db.commit()
+    except Exception:
+        db.rollback()
+        for cart_db in cart_sessions:
+            cart_db.rollback()
+        raise
+    return affected
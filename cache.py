@@ -0,0 +1,84 @@
+# cache.py
+
+"""
+This module provides the rendered-fragment cache used by the product listings.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, Optional
+from flask import current_app
+from markupsafe import Markup
+
+class FragmentCache:
+    """
+    Bounded LRU cache of rendered HTML fragments.
+
+    Keys include the persisted catalog version, so a change made through any worker
+    makes every worker miss, and fragments of older versions age out of the LRU.
+
+    Attributes:
+        max_entries (int): Maximum number of fragments kept in memory.
+        row_counts (Dict[str, int]): Rows in the last rendering of each fragment template.
+    """
+
+    def __init__(self, max_entries: int = 64) -> None:
+        self.max_entries = max_entries
+        self.row_counts: Dict[str, int] = {}
+        self._entries: 'OrderedDict[Hashable, Markup]' = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable) -> Optional[Markup]:
+        """
+        Return the cached fragment for a key, or None on a miss.
+        """
+        with self._lock:
+            fragment = self._entries.get(key)
+            if fragment is not None:
+                self._entries.move_to_end(key)
+            return fragment
+
+    def set(self, key: Hashable, fragment: Markup) -> None:
+        """
+        Store a rendered fragment, evicting the least recently used one if full.
+        """
+        with self._lock:
+            self._entries[key] = fragment
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        Drop every cached fragment and the recorded row counts.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.row_counts.clear()
+
+def render_fragment(cache: FragmentCache, key: Hashable, template_name: str,
+                    load: Callable[[], Iterable[Any]], **context: Any) -> Iterator[Markup]:
+    """
+    Render a fragment chunk by chunk, storing the full fragment in the cache once done.
+
+    Rows are produced by `load` while the template renders, so the page embedding the
+    fragment can be streamed to the client before the last row has been read. The
+    number of rows is recorded in `cache.row_counts`.
+    """
+    rows = 0
+
+    def counted() -> Iterator[Any]:
+        nonlocal rows
+        for row in load():
+            rows += 1
+            yield row
+
+    context['products'] = counted()
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+    chunks = []
+    for chunk in template.generate(context):
+        chunks.append(chunk)
+        yield Markup(chunk)
+    cache.row_counts[template_name] = rows
+    cache.set(key, Markup(''.join(chunks)))
@@ -0,0 +1,143 @@
+# carts.py
+
+"""
+This module handles guest carts kept in the signed session cookie, their merge into
+the persistent cart at login, and the purge of abandoned persistent carts.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+from typing import Dict, List
+from flask import session
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.orm import Session
+from models import CartItem, Product, utcnow
+
+GUEST_CART_KEY = 'guest_cart'
+# Keeps the session cookie well under the 4 KB browsers accept
+GUEST_CART_MAX_ITEMS = 50
+
+# A cart row with its product loaded from the catalog, as the cart template expects.
+# The id of a guest cart line is its product id.
+CartLine = namedtuple('CartLine', ['id', 'product', 'quantity'])
+
+def get_guest_cart() -> Dict[int, int]:
+    """
+    Return the guest cart as a mapping of product id to quantity.
+    """
+    return {int(product_id): quantity for product_id, quantity in session.get(GUEST_CART_KEY, {}).items()}
+
+def _save_guest_cart(cart: Dict[int, int]) -> None:
+    session[GUEST_CART_KEY] = {str(product_id): quantity for product_id, quantity in cart.items()}
+
+def add_to_guest_cart(product_id: int) -> bool:
+    """
+    Add one unit of a product to the guest cart.
+
+    Returns False if the cart already holds the maximum number of distinct products.
+    """
+    cart = get_guest_cart()
+    if product_id not in cart and len(cart) >= GUEST_CART_MAX_ITEMS:
+        return False
+    cart[product_id] = cart.get(product_id, 0) + 1
+    _save_guest_cart(cart)
+    return True
+
+def remove_from_guest_cart(product_id: int) -> bool:
+    """
+    Remove a product from the guest cart, returning whether it was there.
+    """
+    cart = get_guest_cart()
+    if cart.pop(product_id, None) is None:
+        return False
+    _save_guest_cart(cart)
+    return True
+
+def load_guest_cart_items(catalog: Session) -> List[CartLine]:
+    """
+    Load the products of the guest cart in one query, skipping products that no longer exist.
+    """
+    cart = get_guest_cart()
+    if not cart:
+        return []
+    products: List[Product] = catalog.query(Product).filter(Product.id.in_(cart)).all()
+    return [CartLine(product.id, product, cart[product.id]) for product in products]
+
+def load_cart_items(catalog: Session, db: Session, user_id: int) -> List[CartLine]:
+    """
+    Load a user's persistent cart from its shard and the products from the catalog.
+    """
+    items: List[CartItem] = db.query(CartItem).filter_by(user_id=user_id).order_by(CartItem.id).all()
+    if not items:
+        return []
+    products: Dict[int, Product] = {product.id: product for product in catalog.query(Product).filter(
+        Product.id.in_({item.product_id for item in items}))}
+    return [CartLine(item.id, products[item.product_id], item.quantity)
+            for item in items if item.product_id in products]
+
+def merge_guest_cart(catalog: Session, db: Session, user_id: int) -> int:
+    """
+    Move the guest cart into the user's persistent cart, held by `db`, in one transaction.
+
+    Quantities of products already in the persistent cart are added up with a single
+    bulk UPDATE, the other products are added with a single bulk INSERT.
+
+    Returns the number of products merged.
+    """
+    cart = get_guest_cart()
+    if not cart:
+        return 0
+    existing_products = {product_id for (product_id,) in catalog.query(Product.id).filter(Product.id.in_(cart))}
+    quantities = {product_id: quantity for product_id, quantity in cart.items() if product_id in existing_products}
+    if not quantities:
+        session.pop(GUEST_CART_KEY, None)
+        return 0
+    now: datetime = utcnow()
+    rows = db.query(CartItem.id, CartItem.product_id, CartItem.quantity).filter(
+        CartItem.user_id == user_id, CartItem.product_id.in_(quantities)).all()
+    updates = []
+    for row in rows:
+        if row.product_id in quantities:
+            updates.append({'id': row.id, 'quantity': row.quantity + quantities.pop(row.product_id), 'updated_at': now})
+    if updates:
+        db.execute(update(CartItem), updates)
+    if quantities:
+        db.execute(insert(CartItem), [
+            {'user_id': user_id, 'product_id': product_id, 'quantity': quantity, 'updated_at': now}
+            for product_id, quantity in quantities.items()
+        ])
+    db.commit()
+    # Only now, so a failed merge leaves the guest cart to merge at the next login
+    session.pop(GUEST_CART_KEY, None)
+    return len(updates) + len(quantities)
+
+def stamp_untimed_carts(db: Session) -> int:
+    """
+    Give cart items that predate timestamps the current time, returning how many there were.
+
+    Their carts then count as touched at the upgrade, instead of as abandoned forever.
+    """
+    stamped = db.query(CartItem).filter(CartItem.updated_at.is_(None)).update(
+        {CartItem.updated_at: utcnow()}, synchronize_session=False)
+    db.commit()
+    return stamped
+
+def purge_abandoned_carts(db: Session, older_than: datetime, chunk_size: int = 1000) -> int:
+    """
+    Delete the carts of users who have not touched any of their items since `older_than`,
+    `chunk_size` users per transaction.
+
+    A cart is only purged as a whole: items added long ago to a cart still in use stay.
+
+    Returns the number of items deleted.
+    """
+    deleted = 0
+    while True:
+        # Picked in the DELETE itself, so an item added meanwhile keeps its cart
+        abandoned = select(CartItem.user_id).group_by(CartItem.user_id).having(
+            func.max(CartItem.updated_at) < older_than).limit(chunk_size)
+        count = db.query(CartItem).filter(CartItem.user_id.in_(abandoned)).delete(synchronize_session=False)
+        db.commit()
+        if not count:
+            return deleted
+        deleted += count
@@ -0,0 +1,97 @@
+# catalog.py
+
+"""
+This module versions catalog changes and pages through them as an incremental feed.
+
+Every flush that adds, changes or deletes products stamps them with the next catalog
+version, and deletions leave a tombstone carrying that version. Clients mirroring the
+catalog remember the last version they saw and ask only for what changed after it.
+"""
+
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import and_, event, func, or_, select, union_all
+from sqlalchemy.orm import Session
+from models import Product, ProductTombstone
+
+def current_version(db: Session) -> int:
+    """
+    Return the catalog version of the latest product change or deletion, 0 if none.
+    """
+    latest = db.scalars(union_all(select(func.max(Product.version)), select(func.max(ProductTombstone.version))))
+    return max(version or 0 for version in latest)
+
+def next_version(db: Session) -> int:
+    """
+    Return the catalog version following the latest product change or deletion.
+    """
+    return current_version(db) + 1
+
+def stamp_unversioned(db: Session) -> int:
+    """
+    Give products that predate versioning a version, returning how many there were.
+    """
+    if db.query(Product.id).filter(Product.version.is_(None)).first() is None:
+        return 0
+    stamped = db.query(Product).filter(Product.version.is_(None)).update(
+        {Product.version: next_version(db)}, synchronize_session=False)
+    db.commit()
+    return stamped
+
+@event.listens_for(Session, 'before_flush')
+def _stamp_product_changes(session: Session, flush_context, instances) -> None:
+    changed = [obj for obj in session.new if isinstance(obj, Product)]
+    changed += [obj for obj in session.dirty if isinstance(obj, Product) and session.is_modified(obj)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, Product)]
+    if not changed and not deleted:
+        return
+    version = next_version(session)
+    for product in changed:
+        product.version = version
+    for product in deleted:
+        session.merge(ProductTombstone(product_id=product.id, version=version))
+
+@event.listens_for(Session, 'after_flush')
+def _drop_reused_tombstones(session: Session, flush_context) -> None:
+    # SQLite may hand the id of a deleted product to a new one, which supersedes the tombstone
+    ids = [obj.id for obj in session.new if isinstance(obj, Product)]
+    if ids:
+        session.query(ProductTombstone).filter(ProductTombstone.product_id.in_(ids)).delete(synchronize_session=False)
+
+def _product_change(product: Product) -> Dict:
+    return {'id': product.id, 'version': product.version, 'deleted': False, 'name': product.name,
+            'description': product.description, 'price': product.price, 'stock': product.stock}
+
+def _tombstone_change(tombstone: ProductTombstone) -> Dict:
+    return {'id': tombstone.product_id, 'version': tombstone.version, 'deleted': True}
+
+def _after(version_column, id_column, since: int, after_id: Optional[int]):
+    if after_id is None:
+        return version_column > since
+    # The range on the version alone lets SQLite use its index
+    return and_(version_column >= since, or_(version_column > since, id_column > after_id))
+
+def load_changes(db: Session, since: int, limit: int,
+                 after_id: Optional[int] = None) -> Tuple[List[Dict], int, Optional[int], bool]:
+    """
+    Load up to `limit` product changes and deletions, oldest first, from after the
+    cursor: everything after version `since`, or when `after_id` is given, the rest of
+    version `since` past that product id and everything after it.
+
+    A bulk change gives many products one version, so pages may end inside a version;
+    the cursor returned resumes right after the last change of the page.
+
+    Returns the changes, the cursor's `since` and `after_id` for the next page, and
+    whether more changes are waiting.
+    """
+    products = db.query(Product).filter(_after(Product.version, Product.id, since, after_id)).order_by(
+        Product.version, Product.id).limit(limit + 1)
+    tombstones = db.query(ProductTombstone).filter(
+        _after(ProductTombstone.version, ProductTombstone.product_id, since, after_id)).order_by(
+        ProductTombstone.version, ProductTombstone.product_id).limit(limit + 1)
+    changes = sorted([_product_change(product) for product in products] + [_tombstone_change(t) for t in tombstones],
+                     key=lambda change: (change['version'], change['id']))
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    if not changes:
+        return changes, since, after_id, False
+    return changes, changes[-1]['version'], changes[-1]['id'], has_more
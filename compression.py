@@ -0,0 +1,259 @@
+# compression.py
+
+"""
+This module provides the WSGI middleware that compresses dynamic responses.
+
+gzip is always available; brotli and zstd are negotiated only when the optional
+`brotli` and `zstandard` packages are installed.
+"""
+
+import itertools
+import time
+import zlib
+from collections import defaultdict
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+SKIPPED_STATUSES = ('1', '204', '206', '304')
+DEFAULT_LEVELS = {'br': 4, 'zstd': 3, 'gzip': 6}
+ROUTE_KEY = 'compression.route'
+
+class _GzipEncoder:
+    def __init__(self, level: int) -> None:
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._obj.flush()
+
+class _BrotliEncoder:
+    def __init__(self, level: int) -> None:
+        self._obj = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.process(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush()
+
+    def finish(self) -> bytes:
+        return self._obj.finish()
+
+class _ZstdEncoder:
+    def __init__(self, level: int) -> None:
+        self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self._obj.flush()
+
+# Content-Encoding token and encoder, in order of server preference
+ENCODERS: List[Tuple[str, Callable[[int], Any]]] = [('gzip', _GzipEncoder)]
+if brotli is not None:
+    ENCODERS.insert(0, ('br', _BrotliEncoder))
+if zstandard is not None:
+    ENCODERS.insert(0, ('zstd', _ZstdEncoder))
+
+class CompressionStats:
+    """
+    Per-route compression counters.
+
+    Each route maps to responses, bytes_in, bytes_out and cpu_seconds totals.
+    """
+
+    def __init__(self) -> None:
+        self._routes: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: {'responses': 0, 'bytes_in': 0, 'bytes_out': 0, 'cpu_seconds': 0.0})
+        self._lock = Lock()
+
+    def record(self, route: str, bytes_in: int, bytes_out: int, cpu_seconds: float) -> None:
+        """
+        Add one compressed response to the route's totals.
+        """
+        with self._lock:
+            totals = self._routes[route]
+            totals['responses'] += 1
+            totals['bytes_in'] += bytes_in
+            totals['bytes_out'] += bytes_out
+            totals['cpu_seconds'] += cpu_seconds
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """
+        Return a copy of the totals, with the compression ratio of each route.
+        """
+        with self._lock:
+            result = {route: dict(totals) for route, totals in self._routes.items()}
+        for totals in result.values():
+            totals['ratio'] = totals['bytes_in'] / totals['bytes_out'] if totals['bytes_out'] else 0.0
+        return result
+
+    def clear(self) -> None:
+        """
+        Reset all counters.
+        """
+        with self._lock:
+            self._routes.clear()
+
+class CompressionMiddleware:
+    """
+    WSGI middleware compressing responses with the best encoding the client accepts.
+
+    Bodies smaller than `min_size`, non-text bodies and bodies that already carry a
+    Content-Encoding pass through untouched. Streamed bodies are compressed as they
+    are produced and flushed every `flush_size` input bytes, so streaming is kept.
+    """
+
+    def __init__(self, wsgi_app: Callable, min_size: int = 500, levels: Optional[Dict[str, int]] = None,
+                 flush_size: int = 8192, stats: Optional[CompressionStats] = None) -> None:
+        self.wsgi_app = wsgi_app
+        self.min_size = min_size
+        self.levels = dict(DEFAULT_LEVELS, **(levels or {}))
+        self.flush_size = flush_size
+        self.stats = stats if stats is not None else CompressionStats()
+
+    def __call__(self, environ: Dict[str, Any], start_response: Callable) -> Iterable[bytes]:
+        accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+        encoding = accepted.best_match([token for token, _ in ENCODERS])
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.wsgi_app(environ, start_response)
+
+        captured: List[Any] = []
+
+        def capture_start_response(status: str, headers: List[Tuple[str, str]], exc_info=None):
+            # Nothing has been sent yet, so a later call simply replaces the headers
+            captured[:] = [status, headers, exc_info]
+            return self._no_write
+
+        app_iter = self.wsgi_app(environ, capture_start_response)
+        return self._respond(environ, start_response, app_iter, captured, encoding)
+
+    @staticmethod
+    def _no_write(data: bytes) -> None:
+        raise RuntimeError('The write() callable is not supported by CompressionMiddleware.')
+
+    @staticmethod
+    def _has_length(headers: List[Tuple[str, str]]) -> bool:
+        return any(name.lower() == 'content-length' for name, _ in headers)
+
+    def _compressible(self, status: str, headers: List[Tuple[str, str]]) -> bool:
+        names = {name.lower(): value for name, value in headers}
+        if status.startswith(SKIPPED_STATUSES) or 'content-encoding' in names:
+            return False
+        if 'no-transform' in names.get('cache-control', ''):
+            return False
+        if not names.get('content-type', '').startswith(COMPRESSIBLE_TYPES):
+            return False
+        length = names.get('content-length')
+        return length is None or int(length) >= self.min_size
+
+    def _respond(self, environ: Dict[str, Any], start_response: Callable, app_iter: Iterable[bytes],
+                 captured: List[Any], encoding: str) -> Iterator[bytes]:
+        try:
+            chunks = iter(app_iter)
+            # Buffer bodies of known length whole, and streamed bodies until the threshold
+            # is reached so tiny ones are not compressed
+            buffered: List[bytes] = []
+            size = 0
+            exhausted = False
+            while not captured or (self._compressible(captured[0], captured[1])
+                                   and (size < self.min_size or self._has_length(captured[1]))):
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                buffered.append(chunk)
+                size += len(chunk)
+            status, headers, exc_info = captured
+            if not self._compressible(status, headers) or (exhausted and size < self.min_size):
+                start_response(status, headers, exc_info)
+                yield from buffered
+                yield from chunks
+                return
+
+            headers = self._encoded_headers(headers, encoding)
+            encoder = dict(ENCODERS)[encoding](self.levels[encoding])
+            route = environ.get(ROUTE_KEY, environ.get('PATH_INFO', ''))
+            bytes_in = bytes_out = 0
+            cpu = 0.0
+            if exhausted:
+                data = b''.join(buffered)
+                started = time.thread_time()
+                body = encoder.compress(data) + encoder.finish()
+                cpu += time.thread_time() - started
+                start_response(status, headers + [('Content-Length', str(len(body)))], exc_info)
+                self.stats.record(route, len(data), len(body), cpu)
+                yield body
+                return
+
+            start_response(status, headers, exc_info)
+            pending = 0
+            for chunk in itertools.chain(buffered, chunks):
+                started = time.thread_time()
+                out = encoder.compress(chunk)
+                pending += len(chunk)
+                if pending >= self.flush_size:
+                    out += encoder.flush()
+                    pending = 0
+                cpu += time.thread_time() - started
+                bytes_in += len(chunk)
+                bytes_out += len(out)
+                if out:
+                    yield out
+            started = time.thread_time()
+            out = encoder.finish()
+            cpu += time.thread_time() - started
+            bytes_out += len(out)
+            self.stats.record(route, bytes_in, bytes_out, cpu)
+            yield out
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    @staticmethod
+    def _encoded_headers(headers: List[Tuple[str, str]], encoding: str) -> List[Tuple[str, str]]:
+        """
+        Rewrite the headers of a response whose body is being compressed.
+
+        The length is dropped, Accept-Encoding is added to Vary, and a strong ETag
+        is weakened since the bytes on the wire no longer match it.
+        """
+        result: List[Tuple[str, str]] = []
+        vary: List[str] = []
+        for name, value in headers:
+            lowered = name.lower()
+            if lowered == 'content-length':
+                continue
+            if lowered == 'vary':
+                vary.extend(field.strip() for field in value.split(',') if field.strip())
+                continue
+            if lowered == 'etag' and not value.startswith('W/'):
+                value = 'W/' + value
+            result.append((name, value))
+        if 'accept-encoding' not in (field.lower() for field in vary):
+            vary.append('Accept-Encoding')
+        result.append(('Vary', ', '.join(vary)))
+        result.append(('Content-Encoding', encoding))
+        return result
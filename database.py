@@ -4,7 +4,8 @@
 This module sets up the database connection and session management.
 """
 
-from sqlalchemy import create_engine
+from typing import List
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker, declarative_base, scoped_session
 from flask import g
 
@@ -17,3 +18,73 @@ session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 SessionLocal = scoped_session(session_factory)
 
 Base = declarative_base()
+
+def _lacks_autoincrement(connection, table) -> bool:
+    if not table.dialect_options['sqlite'].get('autoincrement'):
+        return False
+    sql = connection.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                             {'name': table.name}).scalar()
+    return sql is not None and 'AUTOINCREMENT' not in sql.upper()
+
+def _rebuild_table(connection, table, existing) -> None:
+    """
+    Recreate a table from its current declaration and copy its rows over, for changes
+    SQLite cannot make with ALTER TABLE.
+    """
+    old_name = f'{table.name}_rebuild'
+    # Keep foreign keys of other tables pointing at the table's name, not the renamed copy
+    connection.execute(text('PRAGMA legacy_alter_table = ON'))
+    connection.execute(text(f'ALTER TABLE {table.name} RENAME TO {old_name}'))
+    connection.execute(text('PRAGMA legacy_alter_table = OFF'))
+    for index in table.indexes:
+        connection.execute(text(f'DROP INDEX IF EXISTS {index.name}'))
+    table.create(bind=connection)
+    columns = ', '.join(column.name for column in table.columns if column.name in existing)
+    connection.execute(text(f'INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old_name}'))
+    connection.execute(text(f'DROP TABLE {old_name}'))
+
+def upgrade_schema(bind, metadata, tables=None) -> None:
+    """
+    Create missing tables, and add columns and indexes that existing tables lack.
+
+    Only `tables` are considered when given. SQLite can only add nullable columns or
+    columns with a constant default, so new columns on existing tables must be
+    declared that way. Tables declared with `sqlite_autoincrement` but created
+    without it are rebuilt.
+    """
+    metadata.create_all(bind=bind, tables=tables)
+    inspector = inspect(bind)
+    with bind.begin() as connection:
+        for table in tables if tables is not None else metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            if _lacks_autoincrement(connection, table):
+                _rebuild_table(connection, table, existing)
+                continue
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=bind.dialect)
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+
+def missing_schema(bind, metadata, tables=None) -> List[str]:
+    """
+    Return the tables, columns, indexes and AUTOINCREMENT declarations an existing
+    database lacks, which `upgrade_schema` would add. Only `tables` are considered
+    when given.
+    """
+    inspector = inspect(bind)
+    existing_tables = set(inspector.get_table_names())
+    missing: List[str] = []
+    with bind.connect() as connection:
+        for table in tables if tables is not None else metadata.sorted_tables:
+            if table.name not in existing_tables:
+                missing.append(f'table {table.name}')
+                continue
+            if _lacks_autoincrement(connection, table):
+                missing.append(f'AUTOINCREMENT on {table.name}')
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            missing += [f'column {table.name}.{column.name}' for column in table.columns if column.name not in existing]
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            missing += [f'index {index.name}' for index in table.indexes if index.name not in existing]
+    return missing
@@ -0,0 +1,78 @@
+# idempotency.py
+
+"""
+This module records idempotency keys so that retried requests replay their first result.
+"""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Hashable, Optional, Tuple
+
+IN_FLIGHT = 'in_flight'
+COMPLETED = 'completed'
+
+class IdempotencyStore:
+    """
+    Bounded store of in-flight and completed request keys with TTL eviction.
+
+    Attributes:
+        ttl (float): Seconds a key is remembered after it was first seen.
+        max_entries (int): Maximum number of keys kept; the oldest are evicted first.
+    """
+
+    def __init__(self, ttl: float = 24 * 60 * 60, max_entries: int = 10000) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (state, result, expires_at), in insertion order so the oldest come first
+        self._entries: 'OrderedDict[Hashable, Tuple[str, Any, float]]' = OrderedDict()
+        self._lock = Lock()
+
+    def _evict(self, now: float) -> None:
+        while self._entries:
+            key, (_, _, expires_at) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[key]
+
+    def begin(self, key: Hashable) -> Optional[Tuple[str, Any]]:
+        """
+        Mark a key as in flight.
+
+        Returns None if the key is new, in which case the caller must `complete` or
+        `abandon` it, otherwise the existing (state, result) for the key.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry[0], entry[1]
+            self._entries[key] = (IN_FLIGHT, None, now + self.ttl)
+            self._evict(now)
+            return None
+
+    def complete(self, key: Hashable, result: Any) -> None:
+        """
+        Record the result of an in-flight key so that retries replay it.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (COMPLETED, result, entry[2])
+
+    def abandon(self, key: Hashable) -> None:
+        """
+        Forget an in-flight key, allowing the request to be retried for real.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == IN_FLIGHT:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        """
+        Forget every key.
+        """
+        with self._lock:
+            self._entries.clear()
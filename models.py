@@ -7,10 +7,16 @@ This module defines the database models for the e-commerce backend.
 from database import Base
 from typing import List
 from datetime import datetime, timezone
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Text, Index
 from sqlalchemy.orm import relationship
 from flask_login import UserMixin
 
+def utcnow() -> datetime:
+    """
+    Return the current UTC time as a naive datetime, the way SQLite stores it.
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 class User(UserMixin, Base):
     """
     Represents a user in the system.
@@ -42,14 +48,33 @@ class Product(Base):
         description (str): Description of the product.
         price (float): Price of the product.
         stock (int): Quantity available in stock.
+        version (int): Catalog version of the last change to the product.
     """
     __tablename__ = 'products'
+    __table_args__ = (Index('ix_products_version', 'version'),)
 
     id: int = Column(Integer, primary_key=True)
     name: str = Column(String(150), nullable=False)
     description: str = Column(String(500))
     price: float = Column(Float, nullable=False)
     stock: int = Column(Integer, default=0)
+    version: int = Column(Integer)
+
+class ProductTombstone(Base):
+    """
+    Records the deletion of a product for clients syncing catalog changes.
+
+    Attributes:
+        product_id (int): Primary key, the id the deleted product had.
+        version (int): Catalog version of the deletion.
+        deleted_at (datetime): Time when the product was deleted.
+    """
+    __tablename__ = 'product_tombstones'
+    __table_args__ = (Index('ix_product_tombstones_version', 'version'),)
+
+    product_id: int = Column(Integer, primary_key=True, autoincrement=False)
+    version: int = Column(Integer, nullable=False)
+    deleted_at: datetime = Column(DateTime, default=utcnow, nullable=False)
 
 class CartItem(Base):
     """
@@ -60,15 +85,21 @@ class CartItem(Base):
         user_id (int): Foreign key to the user.
         product_id (int): Foreign key to the product.
         quantity (int): Quantity of the product in the cart.
+        updated_at (datetime): Time when the item was last added or changed.
         user (User): The user who owns the cart item.
         product (Product): The product added to the cart.
     """
     __tablename__ = 'cart_items'
+    __table_args__ = (
+        Index('ix_cart_items_user_product', 'user_id', 'product_id'),
+        Index('ix_cart_items_updated_at', 'updated_at'),
+    )
 
     id: int = Column(Integer, primary_key=True)
     user_id: int = Column(Integer, ForeignKey('users.id'))
     product_id: int = Column(Integer, ForeignKey('products.id'))
     quantity: int = Column(Integer, default=1)
+    updated_at: datetime = Column(DateTime, default=utcnow, onupdate=utcnow)
 
     user = relationship('User', back_populates='cart_items')
     product = relationship('Product')
@@ -82,15 +113,23 @@ class Order(Base):
         user_id (int): Foreign key to the user.
         timestamp (datetime): Time when the order was placed.
         total_price (float): Total price of the order.
+        idempotency_key (str): Key of the checkout request that placed the order, if any.
         items (List[OrderItem]): List of items in the order.
         user (User): The user who placed the order.
     """
     __tablename__ = 'orders'
+    # Ids are never reused, archived orders keep theirs
+    __table_args__ = (
+        Index('ix_orders_user_timestamp', 'user_id', 'timestamp'),
+        Index('ix_orders_user_idempotency_key', 'user_id', 'idempotency_key', unique=True),
+        {'sqlite_autoincrement': True},
+    )
 
     id: int = Column(Integer, primary_key=True)
     user_id: int = Column(Integer, ForeignKey('users.id'))
-    timestamp: datetime = Column(DateTime, default=datetime.now(timezone.utc))
+    timestamp: datetime = Column(DateTime, default=utcnow)
     total_price: float = Column(Float)
+    idempotency_key: str = Column(String(64))
     items = relationship('OrderItem', back_populates='order', cascade='all, delete-orphan')
     user = relationship('User', back_populates='orders')
 
@@ -102,16 +141,132 @@ class OrderItem(Base):
         id (int): Primary key.
         order_id (int): Foreign key to the order.
         product_id (int): Foreign key to the product.
+        product_name (str): Name of the product when it was ordered, None for older orders.
         quantity (int): Quantity of the product ordered.
         order (Order): The order containing this item.
         product (Product): The product that was ordered.
     """
     __tablename__ = 'order_items'
+    __table_args__ = (Index('ix_order_items_order_id', 'order_id'), {'sqlite_autoincrement': True})
 
     id: int = Column(Integer, primary_key=True)
     order_id: int = Column(Integer, ForeignKey('orders.id'))
     product_id: int = Column(Integer, ForeignKey('products.id'))
+    product_name: str = Column(String(150))
     quantity: int = Column(Integer)
 
     order = relationship('Order', back_populates='items')
-    product = relationship('Product')
\ No newline at end of file
+    product = relationship('Product')
+
+class ArchivedOrder(Base):
+    """
+    Represents an order moved out of the hot `orders` table by the archival job.
+
+    Attributes:
+        id (int): Primary key, the id the order had in `orders`.
+        user_id (int): Foreign key to the user.
+        timestamp (datetime): Time when the order was placed.
+        total_price (float): Total price of the order.
+        items (List[ArchivedOrderItem]): List of items in the order.
+    """
+    __tablename__ = 'orders_archive'
+    __table_args__ = (Index('ix_orders_archive_user_timestamp', 'user_id', 'timestamp'),)
+
+    id: int = Column(Integer, primary_key=True, autoincrement=False)
+    user_id: int = Column(Integer, ForeignKey('users.id'))
+    timestamp: datetime = Column(DateTime)
+    total_price: float = Column(Float)
+    items = relationship('ArchivedOrderItem', back_populates='order', cascade='all, delete-orphan')
+
+class ArchivedOrderItem(Base):
+    """
+    Represents an item of an archived order.
+
+    Attributes:
+        id (int): Primary key, the id the item had in `order_items`.
+        order_id (int): Foreign key to the archived order.
+        product_id (int): Foreign key to the product.
+        product_name (str): Name of the product when it was ordered, None for older orders.
+        quantity (int): Quantity of the product ordered.
+        order (ArchivedOrder): The archived order containing this item.
+        product (Product): The product that was ordered.
+    """
+    __tablename__ = 'order_items_archive'
+    __table_args__ = (Index('ix_order_items_archive_order_id', 'order_id'),)
+
+    id: int = Column(Integer, primary_key=True, autoincrement=False)
+    order_id: int = Column(Integer, ForeignKey('orders_archive.id'))
+    product_id: int = Column(Integer, ForeignKey('products.id'))
+    product_name: str = Column(String(150))
+    quantity: int = Column(Integer)
+
+    order = relationship('ArchivedOrder', back_populates='items')
+    product = relationship('Product')
+
+class OutboxEvent(Base):
+    """
+    Represents follow-up work recorded in the same transaction as the change causing it.
+
+    Attributes:
+        id (int): Primary key.
+        topic (str): Kind of event, used to pick its handlers.
+        payload (str): JSON-encoded event data.
+        created_at (datetime): Time when the event was recorded.
+        available_at (datetime): Earliest time the event may be (re)tried.
+        attempts (int): Number of failed handling attempts.
+        last_error (str): Error raised by the last failed attempt.
+        processed_at (datetime): Time when the event was handled, None while pending.
+    """
+    __tablename__ = 'outbox_events'
+    __table_args__ = (Index('ix_outbox_events_pending', 'processed_at', 'available_at'),)
+
+    id: int = Column(Integer, primary_key=True)
+    topic: str = Column(String(100), nullable=False)
+    payload: str = Column(Text, nullable=False)
+    created_at: datetime = Column(DateTime, default=utcnow, nullable=False)
+    available_at: datetime = Column(DateTime, default=utcnow, nullable=False)
+    attempts: int = Column(Integer, default=0, nullable=False)
+    last_error: str = Column(String(500))
+    processed_at: datetime = Column(DateTime)
+
+class StockAllocation(Base):
+    """
+    Records the stock of a product the catalog handed to a shard to sell on its own.
+
+    Totals only grow. The units the shard may still sell, as far as the catalog knows,
+    are `quantity - sold - released`; `sold` and `released` trail the shard's own
+    totals until they are reconciled.
+
+    Attributes:
+        shard (int): Primary key, index of the shard.
+        product_id (int): Primary key, foreign key to the product.
+        quantity (int): Units allocated to the shard in total.
+        sold (int): Units the shard sold, as of the last reconciliation.
+        released (int): Unsold units the shard handed back, as of the last reconciliation.
+    """
+    __tablename__ = 'stock_allocations'
+    __table_args__ = (Index('ix_stock_allocations_product_id', 'product_id'),)
+
+    shard: int = Column(Integer, primary_key=True, autoincrement=False)
+    product_id: int = Column(Integer, ForeignKey('products.id'), primary_key=True, autoincrement=False)
+    quantity: int = Column(Integer, default=0, nullable=False)
+    sold: int = Column(Integer, default=0, nullable=False)
+    released: int = Column(Integer, default=0, nullable=False)
+
+class ShardStock(Base):
+    """
+    Records, in a shard, what it did with the stock the catalog allocated to it.
+
+    Checkouts update it in the same transaction as the order, so it is exact. Totals
+    only grow, which makes reconciling them into the catalog idempotent.
+
+    Attributes:
+        product_id (int): Primary key, foreign key to the product.
+        sold (int): Units sold by the shard in total.
+        released (int): Unsold units handed back to the catalog in total.
+    """
+    __tablename__ = 'shard_stock'
+
+    product_id: int = Column(Integer, ForeignKey('products.id'), primary_key=True, autoincrement=False)
+    sold: int = Column(Integer, default=0, nullable=False)
+    released: int = Column(Integer, default=0, nullable=False)
@@ -0,0 +1,207 @@
+# outbox.py
+
+"""
+This module drains the transactional outbox with a pool of background worker threads.
+
+Events are written with `enqueue` in the same transaction as the change they follow
+up on, so they are recorded if and only if that change commits. Handlers run at
+least once per event and must therefore be idempotent.
+"""
+
+import json
+import logging
+import threading
+from collections import defaultdict
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from typing import Any, Callable, ContextManager, Dict, List, Optional
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from models import OutboxEvent, utcnow
+
+Handler = Callable[[Session, Dict[str, Any]], None]
+
+def enqueue(db: Session, topic: str, payload: Dict[str, Any]) -> OutboxEvent:
+    """
+    Add an event to the session; it is stored when the caller commits.
+    """
+    event = OutboxEvent(topic=topic, payload=json.dumps(payload))
+    db.add(event)
+    return event
+
+def purge_processed(db: Session, older_than: datetime, chunk_size: int = 1000) -> int:
+    """
+    Delete events handled before `older_than`, `chunk_size` events per transaction.
+
+    Pending and dead events stay, whatever their age.
+
+    Returns the number of events deleted.
+    """
+    deleted = 0
+    while True:
+        # Picked through the pending index, which leads with `processed_at`
+        processed = select(OutboxEvent.id).where(OutboxEvent.processed_at < older_than).limit(chunk_size)
+        count = db.query(OutboxEvent).filter(OutboxEvent.id.in_(processed)).delete(synchronize_session=False)
+        db.commit()
+        if not count:
+            return deleted
+        deleted += count
+
+class OutboxWorker:
+    """
+    In-process pool of threads handling outbox events in batches, with retry and backoff.
+
+    Attributes:
+        session_factory (Callable[[int], Session]): Opens a session on a shard for each batch.
+        shards (int): Number of databases holding an outbox table.
+        threads (int): Number of worker threads.
+        batch_size (int): Maximum number of events claimed at once.
+        poll_interval (float): Seconds an idle worker waits before polling again.
+        max_attempts (int): Failed attempts after which an event is left dead.
+        backoff (float): Delay before the first retry, doubled on each further failure.
+        lease (float): Seconds a claimed event is hidden from other workers.
+        context_factory (Callable[[], ContextManager]): Opens the context each worker thread
+            runs in, such as a Flask app context for session factories using `current_app`.
+    """
+
+    def __init__(self, session_factory: Callable[[int], Session], shards: int = 1, threads: int = 2,
+                 batch_size: int = 50, poll_interval: float = 1.0, max_attempts: int = 5,
+                 backoff: float = 2.0, lease: float = 60.0,
+                 context_factory: Optional[Callable[[], ContextManager]] = None) -> None:
+        self.session_factory = session_factory
+        self.shards = shards
+        self.threads = threads
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.context_factory = context_factory or nullcontext
+        self.handlers: Dict[str, List[Handler]] = defaultdict(list)
+        self.processed = 0
+        self.failed = 0
+        self._claim_lock = threading.Lock()
+        self._counter_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._workers: List[threading.Thread] = []
+
+    def handler(self, topic: str) -> Callable[[Handler], Handler]:
+        """
+        Decorator registering a handler for a topic.
+        """
+        def decorator(f: Handler) -> Handler:
+            self.handlers[topic].append(f)
+            return f
+        return decorator
+
+    def _claim(self, db: Session) -> List[OutboxEvent]:
+        """
+        Claim a batch of due events by pushing their availability past the lease.
+        """
+        now = utcnow()
+        with self._claim_lock:
+            events: List[OutboxEvent] = db.query(OutboxEvent).filter(
+                OutboxEvent.processed_at.is_(None),
+                OutboxEvent.available_at <= now,
+                OutboxEvent.attempts < self.max_attempts,
+            ).order_by(OutboxEvent.id).limit(self.batch_size).all()
+            for event in events:
+                event.available_at = now + timedelta(seconds=self.lease)
+            db.commit()
+        return events
+
+    def drain_once(self) -> int:
+        """
+        Claim and handle one batch of events from every shard.
+
+        Returns the number of events claimed.
+        """
+        return sum(self._drain_shard(shard) for shard in range(self.shards))
+
+    def _drain_shard(self, shard: int) -> int:
+        db: Session = self.session_factory(shard)
+        try:
+            events = self._claim(db)
+            for event in events:
+                try:
+                    payload = json.loads(event.payload)
+                    for handle in self.handlers.get(event.topic, []):
+                        handle(db, payload)
+                    event.processed_at = utcnow()
+                    db.commit()
+                    with self._counter_lock:
+                        self.processed += 1
+                except Exception as error:
+                    db.rollback()
+                    event.attempts += 1
+                    event.last_error = repr(error)[:500]
+                    event.available_at = utcnow() + timedelta(seconds=self.backoff * 2 ** (event.attempts - 1))
+                    db.commit()
+                    with self._counter_lock:
+                        self.failed += 1
+                    logging.exception(f"Outbox event {event.id} ({event.topic}) failed, attempt {event.attempts}")
+            return len(events)
+        finally:
+            db.close()
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Return the queue depth, the age of the oldest pending event and the handling counters.
+        """
+        depth = dead = 0
+        oldest = None
+        for shard in range(self.shards):
+            db: Session = self.session_factory(shard)
+            try:
+                pending = db.query(OutboxEvent).filter(OutboxEvent.processed_at.is_(None),
+                                                       OutboxEvent.attempts < self.max_attempts)
+                depth += pending.count()
+                shard_oldest = pending.with_entities(func.min(OutboxEvent.created_at)).scalar()
+                if shard_oldest is not None and (oldest is None or shard_oldest < oldest):
+                    oldest = shard_oldest
+                dead += db.query(OutboxEvent).filter(OutboxEvent.processed_at.is_(None),
+                                                     OutboxEvent.attempts >= self.max_attempts).count()
+            finally:
+                db.close()
+        return {
+            'queue_depth': depth,
+            'lag_seconds': (utcnow() - oldest).total_seconds() if oldest else 0.0,
+            'dead': dead,
+            'processed': self.processed,
+            'failed': self.failed,
+        }
+
+    def _run(self) -> None:
+        with self.context_factory():
+            while not self._stop.is_set():
+                try:
+                    claimed = self.drain_once()
+                except Exception:
+                    logging.exception("Outbox worker failed to drain a batch")
+                    claimed = 0
+                if claimed < self.batch_size:
+                    self._stop.wait(self.poll_interval)
+
+    def start(self) -> None:
+        """
+        Start the worker threads, unless they are already running.
+        """
+        with self._start_lock:
+            if self._workers:
+                return
+            self._stop.clear()
+            self._workers = [threading.Thread(target=self._run, name=f'outbox-worker-{i}', daemon=True)
+                             for i in range(self.threads)]
+            for worker in self._workers:
+                worker.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Ask the worker threads to stop and wait for them.
+        """
+        with self._start_lock:
+            self._stop.set()
+            for worker in self._workers:
+                worker.join(timeout)
+            self._workers = []
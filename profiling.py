@@ -0,0 +1,142 @@
+# profiling.py
+
+"""
+This module captures the SQL statements a request runs, with their duration and
+SQLite query plan, and flags full table scans, repeated statements and slow queries.
+
+Statements are only recorded while a collection is open: the app opens one around
+each request when SQL_PROFILING is on, and tests open one with `capture()` around a
+request to check its query budget.
+"""
+
+import logging
+import threading
+import time
+from collections import Counter, deque, namedtuple
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+QueryRecord = namedtuple('QueryRecord', ['statement', 'duration_ms', 'plan'])
+
+# Statements with a query plan worth checking
+EXPLAINED_PREFIXES = ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT')
+
+def scanned_tables(record: QueryRecord) -> List[str]:
+    """
+    Return the tables a statement reads in full, according to its query plan.
+    """
+    # Subqueries are scanned once built, which reads no table in full by itself
+    subqueries = {'CONSTANT'}
+    tables = []
+    for detail in record.plan:
+        words = detail.split()
+        if len(words) > 1 and words[0] in ('CO-ROUTINE', 'MATERIALIZE'):
+            subqueries.add(words[1])
+        elif len(words) > 1 and words[0] == 'SCAN' and words[1] not in subqueries and not words[1].startswith('('):
+            tables.append(words[1])
+    return tables
+
+def summarize(records: List[QueryRecord], slow_ms: float) -> Dict:
+    """
+    Summarize the statements of one request: totals, scans, repeats and slow statements.
+    """
+    counts = Counter(record.statement for record in records)
+    return {
+        'queries': len(records),
+        'total_ms': round(sum(record.duration_ms for record in records), 3),
+        'scans': [{'tables': scanned_tables(record), 'statement': record.statement}
+                  for record in records if scanned_tables(record)],
+        'repeated': {statement: count for statement, count in counts.items() if count > 1},
+        'slow': [{'duration_ms': round(record.duration_ms, 3), 'statement': record.statement}
+                 for record in records if record.duration_ms >= slow_ms],
+    }
+
+class QueryProfiler:
+    """
+    Records the statements run on instrumented engines by the current thread.
+
+    Attributes:
+        slow_ms (float): Duration from which a statement is reported as slow.
+        reports (deque): Summaries of the latest profiled requests, newest last.
+    """
+
+    def __init__(self, slow_ms: float = 100.0, max_reports: int = 100) -> None:
+        self.slow_ms = slow_ms
+        self.reports = deque(maxlen=max_reports)
+        self._local = threading.local()
+
+    def _collectors(self) -> List[List[QueryRecord]]:
+        if not hasattr(self._local, 'collectors'):
+            self._local.collectors = []
+        return self._local.collectors
+
+    def instrument(self, engine: Engine) -> None:
+        """
+        Time and explain the statements run on an engine while a capture is open.
+        """
+        @event.listens_for(engine, 'before_cursor_execute')
+        def start_timer(conn: Any, cursor: Any, statement: str, parameters: Any, context: Any,
+                        executemany: bool) -> None:
+            if self._collectors():
+                conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def record(conn: Any, cursor: Any, statement: str, parameters: Any, context: Any,
+                   executemany: bool) -> None:
+            collectors = self._collectors()
+            if not collectors:
+                return
+            duration_ms = (time.perf_counter() - conn.info['query_start'].pop()) * 1000
+            plan: List[str] = []
+            if conn.dialect.name == 'sqlite' and statement.lstrip().upper().startswith(EXPLAINED_PREFIXES):
+                # Explain on the same connection, so the plan sees the request's transaction
+                explain_parameters = parameters[0] if executemany and parameters else parameters
+                plan = [row[3] for row in cursor.connection.execute(
+                    f'EXPLAIN QUERY PLAN {statement}', explain_parameters or ())]
+            for collector in collectors:
+                collector.append(QueryRecord(' '.join(statement.split()), duration_ms, plan))
+
+    def begin(self) -> List[QueryRecord]:
+        """
+        Start collecting the statements this thread runs into the returned list.
+        """
+        records: List[QueryRecord] = []
+        self._collectors().append(records)
+        return records
+
+    def end(self, records: List[QueryRecord]) -> None:
+        """
+        Stop collecting into a list returned by `begin`.
+        """
+        collectors = self._collectors()
+        # Collections of the same statements compare equal, so remove by identity
+        collectors.pop(next(i for i, collector in enumerate(collectors) if collector is records))
+
+    @contextmanager
+    def capture(self) -> Iterator[List[QueryRecord]]:
+        """
+        Collect the statements this thread runs until the block exits.
+        """
+        records = self.begin()
+        try:
+            yield records
+        finally:
+            self.end(records)
+
+    def report(self, route: str, records: List[QueryRecord]) -> Dict:
+        """
+        Summarize a request, keep the summary and log what looks wrong.
+        """
+        summary = summarize(records, self.slow_ms)
+        summary['route'] = route
+        self.reports.append(summary)
+        for scan in summary['scans']:
+            logging.warning(f"{route}: full scan of {', '.join(scan['tables'])}: {scan['statement']}")
+        for statement, count in summary['repeated'].items():
+            logging.warning(f"{route}: statement run {count} times: {statement}")
+        for slow in summary['slow']:
+            logging.warning(f"{route}: slow statement ({slow['duration_ms']} ms): {slow['statement']}")
+        logging.debug(f"{route}: {summary['queries']} statements in {summary['total_ms']} ms")
+        return summary
@@ -0,0 +1,97 @@
+# ratelimit.py
+
+"""
+This module provides in-process admission control for the expensive routes.
+"""
+
+import math
+import time
+from collections import OrderedDict
+from threading import BoundedSemaphore, Lock
+from typing import Sequence, Tuple
+
+class TokenBuckets:
+    """
+    Token buckets for many keys, kept in a bounded LRU map.
+
+    A bucket holds at most `burst` tokens and refills at `rate` tokens per second.
+    When more than `max_keys` buckets exist the least recently used one is evicted;
+    an evicted bucket simply starts full again.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 10000) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: 'OrderedDict[str, Tuple[float, float]]' = OrderedDict()
+        self._lock = Lock()
+
+    def _level(self, key: str, now: float) -> float:
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def take(self, keys: Sequence[str]) -> float:
+        """
+        Take one token from every key's bucket, or none if any bucket is empty.
+
+        Returns 0 when the tokens were taken, otherwise the seconds until they would be.
+        """
+        now = time.monotonic()
+        with self._lock:
+            levels = [self._level(key, now) for key in keys]
+            if any(level < 1 for level in levels):
+                return max((1 - level) / self.rate for level in levels)
+            for key, level in zip(keys, levels):
+                self._buckets[key] = (level - 1, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return 0
+
+    def clear(self) -> None:
+        """
+        Drop every bucket.
+        """
+        with self._lock:
+            self._buckets.clear()
+
+class RouteLimiter:
+    """
+    Admission control for one class of routes: a concurrency cap plus token buckets.
+
+    Attributes:
+        buckets (TokenBuckets): Per-user and per-IP request rate limits.
+        concurrency (int): Maximum number of requests handled at once.
+    """
+
+    def __init__(self, rate: float, burst: int, concurrency: int, max_keys: int = 10000) -> None:
+        self.buckets = TokenBuckets(rate, burst, max_keys)
+        self.concurrency = concurrency
+        self._slots = BoundedSemaphore(concurrency)
+
+    def admit(self, keys: Sequence[str]) -> int:
+        """
+        Try to admit a request identified by the given keys.
+
+        Returns 0 when admitted, in which case `release` must be called once the request
+        is done, otherwise the number of seconds the client should wait before retrying.
+        """
+        if not self._slots.acquire(blocking=False):
+            return 1
+        retry_after = self.buckets.take(keys)
+        if retry_after:
+            self._slots.release()
+            return max(1, math.ceil(retry_after))
+        return 0
+
+    def release(self) -> None:
+        """
+        Free the concurrency slot taken by an admitted request.
+        """
+        self._slots.release()
+
+    def clear(self) -> None:
+        """
+        Drop all rate limit state.
+        """
+        self.buckets.clear()
@@ -0,0 +1,42 @@
+# routing.py
+
+"""
+This module routes database sessions between the writer and the read-only pool.
+
+Read-only route handlers take their session from `read_session()`, which uses the
+read-only engine (`mode=ro` SQLite connections, or a replica later) until the
+current request commits a write, after which reads go to the writer so the request
+sees its own writes.
+"""
+
+from typing import Any
+from flask import current_app, g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+WROTE_FLAG = '_db_wrote'
+
+def enable_wal(engine: Engine) -> None:
+    """
+    Switch SQLite connections to WAL so readers are not blocked by the writer.
+    """
+    @event.listens_for(engine, 'connect')
+    def set_journal_mode(dbapi_connection: Any, connection_record: Any) -> None:
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+@event.listens_for(Session, 'after_commit')
+def _mark_request_wrote(session: Session) -> None:
+    if has_request_context():
+        setattr(g, WROTE_FLAG, True)
+
+def read_session() -> Session:
+    """
+    Return a session for read-only work in the current request.
+    """
+    if has_request_context() and g.get(WROTE_FLAG):
+        return current_app.SessionLocal()
+    return current_app.ReadSessionLocal()
@@ -0,0 +1,221 @@
+# sharding.py
+
+"""
+This module places each user's carts and orders in one of several SQLite shard files.
+
+Products and users stay in the catalog database. When no shard URLs are configured
+every user maps to the catalog database itself, so the same code serves both layouts.
+Rows in different databases cannot be joined, so products are always loaded from
+the catalog separately.
+
+Usage: python sharding.py rebalance [--catalog <url>] --old <url> [<url> ...] --new <url> [<url> ...]
+"""
+
+import argparse
+import zlib
+from typing import Dict, List, Sequence
+from flask import current_app
+from sqlalchemy import create_engine, inspect, select
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from models import Base, CartItem, Order, OrderItem, ArchivedOrder, ArchivedOrderItem, OutboxEvent, ShardStock
+from database import missing_schema, upgrade_schema
+from allocations import adopt_stock_totals, reconcile_stock, release_unsold_stock
+from routing import enable_wal, read_session
+
+# Tables living in the shards; the outbox and the shard's stock totals share them so
+# they commit with their order
+SHARDED_MODELS = [CartItem, Order, OrderItem, ArchivedOrder, ArchivedOrderItem, OutboxEvent, ShardStock]
+SHARDED_TABLES = [model.__table__ for model in SHARDED_MODELS]
+# Per-user rows, parents before children
+USER_MODELS = [CartItem, Order, ArchivedOrder]
+CHILD_MODELS = {Order: OrderItem, ArchivedOrder: ArchivedOrderItem}
+
+def shard_index(user_id: int, count: int) -> int:
+    """
+    Return the shard holding a user's rows, stable across processes and restarts.
+    """
+    return zlib.crc32(str(user_id).encode()) % count
+
+class ShardRouter:
+    """
+    Routes the sessions of per-user tables to the shard of the user.
+
+    Attributes:
+        urls (List[str]): Shard database URLs; empty means the catalog holds everything.
+        engines (List[Engine]): One engine per shard.
+        sessions (List[scoped_session]): One session registry per shard.
+    """
+
+    def __init__(self, urls: Sequence[str], pool_size: int = 2, max_overflow: int = 0) -> None:
+        self.urls = list(urls)
+        self.engines = []
+        self.sessions: List[scoped_session] = []
+        for url in self.urls:
+            engine = create_engine(url, pool_size=pool_size, max_overflow=max_overflow)
+            enable_wal(engine)
+            # Only a new shard gets its tables here; existing ones are upgraded with `upgrade_schema`
+            if not inspect(engine).get_table_names():
+                Base.metadata.create_all(bind=engine, tables=SHARDED_TABLES)
+            self.engines.append(engine)
+            self.sessions.append(scoped_session(sessionmaker(bind=engine)))
+
+    @property
+    def count(self) -> int:
+        """
+        Number of shards; an unsharded router counts the catalog as its single shard.
+        """
+        return max(1, len(self.urls))
+
+    def shard_of(self, user_id: int) -> int:
+        """
+        Return the index of the user's shard.
+        """
+        return shard_index(user_id, self.count)
+
+    def session_for_shard(self, shard: int) -> Session:
+        """
+        Return a session on a shard, or on the catalog when unsharded.
+        """
+        if not self.sessions:
+            return current_app.SessionLocal()
+        return self.sessions[shard]()
+
+    def session(self, user_id: int) -> Session:
+        """
+        Return a session for writing the user's rows.
+        """
+        return self.session_for_shard(self.shard_of(user_id))
+
+    def read_session(self, user_id: int) -> Session:
+        """
+        Return a session for reading the user's rows.
+
+        Unsharded reads go through the read-only routing; shards have a single pool.
+        """
+        if not self.sessions:
+            return read_session()
+        return self.session(user_id)
+
+    def all_sessions(self) -> List[Session]:
+        """
+        Return one session per shard, for jobs that sweep every shard.
+        """
+        return [self.session_for_shard(shard) for shard in range(self.count)]
+
+    def upgrade_schema(self) -> None:
+        """
+        Add the columns and indexes existing shard databases lack.
+        """
+        for engine in self.engines:
+            upgrade_schema(engine, Base.metadata, tables=SHARDED_TABLES)
+
+    def missing_schema(self) -> List[str]:
+        """
+        Return what existing shard databases lack, see `database.missing_schema`.
+        """
+        return [f'{item} (shard {shard})' for shard, engine in enumerate(self.engines)
+                for item in missing_schema(engine, Base.metadata, tables=SHARDED_TABLES)]
+
+    def dispose(self) -> None:
+        """
+        Close every shard session and connection pool.
+        """
+        for registry in self.sessions:
+            registry.remove()
+        for engine in self.engines:
+            engine.dispose()
+
+def _rows(db: Session, model, column, values) -> List[Dict]:
+    columns = [c.name for c in model.__table__.columns]
+    return [dict(zip(columns, row)) for row in db.execute(
+        model.__table__.select().where(column.in_(values)))]
+
+def _delete_user_rows(db: Session, user_id: int) -> None:
+    for model in USER_MODELS:
+        child = CHILD_MODELS.get(model)
+        if child is not None:
+            db.query(child).filter(child.order_id.in_(
+                select(model.id).where(model.user_id == user_id))).delete(synchronize_session=False)
+        db.query(model).filter(model.user_id == user_id).delete(synchronize_session=False)
+
+def move_user(source: Session, target: Session, user_id: int) -> int:
+    """
+    Copy a user's carts and orders from one shard to another, then delete the originals.
+
+    Ids are per shard, so rows get new ids in the target and items follow their order.
+    Rows of the user already in the target are leftovers of an interrupted move and
+    are replaced, which makes the move safe to retry. Returns the number of rows moved.
+    """
+    moved = 0
+    _delete_user_rows(target, user_id)
+    for model in USER_MODELS:
+        rows = _rows(source, model, model.user_id, [user_id])
+        if not rows:
+            continue
+        child = CHILD_MODELS.get(model)
+        children = _rows(source, child, child.order_id, [row['id'] for row in rows]) if child is not None else []
+        new_ids: Dict[int, int] = {}
+        for row in rows:
+            old_id = row.pop('id')
+            new_ids[old_id] = target.execute(model.__table__.insert().values(**row)).inserted_primary_key[0]
+        for child_row in children:
+            del child_row['id']
+            child_row['order_id'] = new_ids[child_row['order_id']]
+        if children:
+            target.execute(child.__table__.insert(), children)
+        moved += len(rows) + len(children)
+    target.commit()
+    _delete_user_rows(source, user_id)
+    source.commit()
+    return moved
+
+def rebalance(old: ShardRouter, new: ShardRouter, user_ids: Sequence[int]) -> int:
+    """
+    Move every listed user whose shard differs between two layouts.
+
+    Writes must be stopped and the outbox drained while this runs. Returns the number
+    of users moved.
+    """
+    moved = 0
+    for user_id in user_ids:
+        old_shard, new_shard = old.shard_of(user_id), new.shard_of(user_id)
+        if old.urls[old_shard] == new.urls[new_shard]:
+            continue
+        source, target = old.session_for_shard(old_shard), new.session_for_shard(new_shard)
+        if move_user(source, target, user_id):
+            moved += 1
+        source.close()
+        target.close()
+    return moved
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Move users between shard layouts.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    rebalance_parser = subparsers.add_parser('rebalance')
+    rebalance_parser.add_argument('--catalog', default='sqlite:///ecommerce.db', help='Catalog database URL')
+    rebalance_parser.add_argument('--old', nargs='+', required=True, help='Current shard URLs, in order')
+    rebalance_parser.add_argument('--new', nargs='+', required=True, help='New shard URLs, in order')
+    args = parser.parse_args()
+
+    old, new = ShardRouter(args.old), ShardRouter(args.new)
+    catalog_engine = create_engine(args.catalog)
+    catalog = sessionmaker(bind=catalog_engine)()
+    user_ids = set()
+    for shard, db in enumerate(old.all_sessions()):
+        for model in USER_MODELS:
+            user_ids.update(user_id for (user_id,) in db.query(model.user_id).distinct())
+        # Stock allocations are per shard index, which the new layout gives other users
+        release_unsold_stock(catalog, db, shard)
+        reconcile_stock(catalog, db, shard)
+        db.close()
+    print(f'Moved {rebalance(old, new, sorted(user_ids))} of {len(user_ids)} users.')
+    for shard, db in enumerate(new.all_sessions()):
+        adopt_stock_totals(catalog, db, shard)
+        db.close()
+    catalog.close()
+    catalog_engine.dispose()
+    old.dispose()
+    new.dispose()
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,25 @@
 # tests.py        
 
+import gzip
+import json
+import os
+import tempfile
+import time
 import unittest
 import uuid
+from datetime import timedelta
 from app import app
-from models import Base, User, Product, CartItem, Order, OrderItem
-from sqlalchemy import create_engine
+from assets import build_assets
+from archive import archive_orders, load_order_page, reserve_archived_ids
+from database import missing_schema, upgrade_schema
+from carts import purge_abandoned_carts, stamp_untimed_carts
+from outbox import OutboxWorker, enqueue, purge_processed
+from routing import read_session
+from sharding import ShardRouter, rebalance, shard_index
+from allocations import allocate_stock, reconcile_stock
+from profiling import QueryRecord, summarize
+from models import Base, User, Product, CartItem, Order, OrderItem, OutboxEvent, ArchivedOrder, ArchivedOrderItem, ShardStock, StockAllocation, utcnow
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker, scoped_session
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -30,6 +45,13 @@ class EcommerceTestCase(unittest.TestCase):
         app.config['TESTING'] = True
         app.engine = self.engine
         app.SessionLocal = self.Session
+        app.ReadSessionLocal = self.Session
+        app.fragment_cache.clear()
+        app.idempotency_store.clear()
+        app.query_profiler.instrument(self.engine)
+        app.query_profiler.reports.clear()
+        for limiter in app.rate_limiters.values():
+            limiter.clear()
 
         self.app_context = app.app_context()
         self.app_context.push()
@@ -80,11 +102,28 @@ class EcommerceTestCase(unittest.TestCase):
         }, follow_redirects=True)
         return response
 
+    def assert_query_budget(self, method, url, max_queries, allow_scans=(), **kwargs):
+        """
+        Helper function to make a request and check its SQL statements stay within budget:
+        at most `max_queries`, no full scan outside `allow_scans` and no repeated statement.
+        Call it outside `with self.client`, which would keep the previous request's context.
+        """
+        # A fresh app context, as each real request gets, so nothing cached in `g` hides a query
+        with app.app_context(), app.query_profiler.capture() as queries:
+            response = self.client.open(url, method=method, **kwargs)
+        summary = summarize(queries, app.query_profiler.slow_ms)
+        statements = '\n'.join(query.statement for query in queries)
+        self.assertLessEqual(summary['queries'], max_queries, statements)
+        self.assertEqual([table for scan in summary['scans'] for table in scan['tables'] if table not in allow_scans],
+                         [], statements)
+        self.assertEqual(summary['repeated'], {})
+        return len(queries)
+
     def place_order_and_verify_cart(self, client, product_id):
         response = client.get(f'/cart/add/{product_id}', follow_redirects=True)
         self.assertIn(b'Product added to cart.', response.data)  # Confirm the product was added to the cart
 
-        response = client.get('/order/place', follow_redirects=True)
+        response = client.post('/order/place', follow_redirects=True)
         self.assertIn(b'Order placed successfully.', response.data)  # Confirm the order was placed successfully
 
 
@@ -156,6 +195,35 @@ class EcommerceTestCase(unittest.TestCase):
         self.assertIn(b'Invalid username or password.', response.data)
 
 
+    def test_login_rate_limited(self):
+        """
+        Test that a burst of logins is shed with a 429 while the storefront stays available.
+        """
+        burst = app.config['RATE_LIMITS']['login']['burst']
+        for _ in range(burst):
+            response = self.client.post('/login', data={'username': 'testuser', 'password': 'wrongpassword'})
+            self.assertEqual(response.status_code, 302)
+
+        response = self.client.post('/login', data={'username': 'testuser', 'password': 'testpass'})
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+        self.assertEqual(self.client.get('/').status_code, 200)
+        self.assertEqual(self.client.get('/login').status_code, 200)
+
+    def test_login_rate_limit_does_not_lock_out_other_clients(self):
+        """
+        Test that failed logins for a username from one IP do not block that user elsewhere.
+        """
+        attacker = {'REMOTE_ADDR': '203.0.113.7'}
+        for _ in range(app.config['RATE_LIMITS']['login']['burst'] + 1):
+            response = self.client.post('/login', data={'username': 'testuser', 'password': 'wrongpassword'},
+                                        environ_base=attacker)
+        self.assertEqual(response.status_code, 429)
+
+        response = self.client.post('/login', data={'username': 'testuser', 'password': 'testpass'},
+                                    environ_base={'REMOTE_ADDR': '198.51.100.2'})
+        self.assertEqual(response.status_code, 302)
+
     # 3. Product Management Test (for Admins)
     def test_admin_edit_product(self): # GREEN
         """
@@ -206,6 +274,120 @@ class EcommerceTestCase(unittest.TestCase):
             self.assertIsNone(deleted_product)  # The product should no longer be in the database
 
 
+    def test_admin_bulk_reprice_and_delete(self):
+        """
+        Test bulk repricing by id and bulk deletion by filter.
+        """
+        self.create_user('admin', 'admin')
+        self.db.query(User).filter_by(username='admin').update({"is_admin": True})
+        ids = [self.create_product(f'Widget {i}', 'Test Description', 10.0, i).id for i in range(3)]
+        self.create_product('Gadget', 'Test Description', 20.0, 0)
+
+        with self.client as client:
+            self.login_user('admin', 'admin')
+            response = client.post('/admin/products/bulk', data={
+                'action': 'price_percent', 'value': '50', 'product_ids': ids[:2]
+            }, follow_redirects=True)
+            self.assertIn(b'2 products affected.', response.data)
+            self.assertEqual([p.price for p in self.db.query(Product).order_by(Product.id)], [15.0, 15.0, 10.0, 20.0])
+
+            response = client.post('/admin/products/bulk', data={
+                'action': 'delete', 'name_contains': 'Widget', 'max_stock': '1'
+            }, follow_redirects=True)
+            self.assertIn(b'2 products affected.', response.data)
+            self.assertEqual(sorted(p.name for p in self.db.query(Product)), ['Gadget', 'Widget 2'])
+
+    def test_admin_bulk_requires_selection(self):
+        """
+        Test that a bulk action without ids or filter is rejected instead of touching every product.
+        """
+        self.create_user('admin', 'admin')
+        self.db.query(User).filter_by(username='admin').update({"is_admin": True})
+        self.create_product('Widget', 'Test Description', 10.0, 5)
+
+        with self.client as client:
+            self.login_user('admin', 'admin')
+            response = client.post('/admin/products/bulk', data={'action': 'set_stock', 'value': '0'},
+                                   follow_redirects=True)
+            self.assertIn(b'No products selected.', response.data)
+            self.assertEqual(self.db.query(Product).one().stock, 5)
+
+    def test_catalog_changes_feed(self):
+        """
+        Test that the change feed returns only rows changed since a version, including deletions.
+        """
+        self.create_user('admin', 'admin')
+        self.db.query(User).filter_by(username='admin').update({"is_admin": True})
+        ids = [self.create_product(f'Widget {i}', 'Test Description', 10.0, 5).id for i in range(3)]
+
+        changes = self.client.get('/catalog/changes').get_json()
+        self.assertEqual([change['id'] for change in changes['changes']], ids)
+        self.assertFalse(changes['has_more'])
+        since = changes['since']
+
+        with self.client as client:
+            self.login_user('admin', 'admin')
+            client.post(f'/admin/products/edit/{ids[0]}', data={
+                'name': 'Renamed', 'description': 'Test Description', 'price': '10.0', 'stock': '5'})
+            client.post(f'/admin/products/delete/{ids[1]}')
+
+        changes = self.client.get(f'/catalog/changes?since={since}').get_json()['changes']
+        self.assertEqual([(change['id'], change['deleted']) for change in changes], [(ids[0], False), (ids[1], True)])
+        self.assertEqual(changes[0]['name'], 'Renamed')
+        self.assertGreater(changes[1]['version'], changes[0]['version'])
+        self.assertEqual(self.client.get('/catalog/changes?since=abc').status_code, 400)
+
+    def test_catalog_changes_pages_bounded_inside_bulk_versions(self):
+        """
+        Test that paging the change feed stays within the page size when a bulk change gives
+        many products one version, resuming inside the version from the returned cursor.
+        """
+        self.create_user('admin', 'admin')
+        self.db.query(User).filter_by(username='admin').update({"is_admin": True})
+        ids = [self.create_product(f'Widget {i}', 'Test Description', 10.0, 5).id for i in range(5)]
+        app.config['CATALOG_CHANGES_MAX_PAGE_SIZE'] = 3
+        self.addCleanup(app.config.__setitem__, 'CATALOG_CHANGES_MAX_PAGE_SIZE', 1000)
+
+        with self.client as client:
+            self.login_user('admin', 'admin')
+            client.post('/admin/products/bulk', data={'action': 'set_stock', 'value': '1', 'product_ids': ids})
+
+        pages = [self.client.get('/catalog/changes?limit=2').get_json()]
+        while pages[-1]['has_more']:
+            pages.append(self.client.get(
+                f"/catalog/changes?limit=2&since={pages[-1]['since']}&after_id={pages[-1]['after_id']}").get_json())
+        self.assertEqual([[change['id'] for change in page['changes']] for page in pages], [ids[:2], ids[2:4], ids[4:]])
+        self.assertEqual({change['stock'] for page in pages for change in page['changes']}, {1})
+        self.assertEqual(len(self.client.get('/catalog/changes?limit=10').get_json()['changes']), 3)
+        last = self.client.get(f"/catalog/changes?since={pages[-1]['since']}&after_id={pages[-1]['after_id']}").get_json()
+        self.assertEqual(last['changes'], [])
+        self.assertFalse(last['has_more'])
+        self.assertEqual(self.client.get('/catalog/changes?after_id=abc').status_code, 400)
+
+    def test_admin_bulk_rejects_wildcards_and_non_finite_values(self):
+        """
+        Test that the name filter matches literally and NaN or infinite values are rejected.
+        """
+        self.create_user('admin', 'admin')
+        self.db.query(User).filter_by(username='admin').update({"is_admin": True})
+        self.create_product('Widget', 'Test Description', 10.0, 5)
+        self.create_product('50% off', 'Test Description', 10.0, 5)
+
+        with self.client as client:
+            self.login_user('admin', 'admin')
+            response = client.post('/admin/products/bulk', data={
+                'action': 'set_stock', 'value': '0', 'name_contains': '%'
+            }, follow_redirects=True)
+            self.assertIn(b'1 products affected.', response.data)
+            self.assertEqual([p.stock for p in self.db.query(Product).order_by(Product.id)], [5, 0])
+
+            for action, value in (('set_stock', 'nan'), ('price_percent', 'inf')):
+                response = client.post('/admin/products/bulk', data={
+                    'action': action, 'value': value, 'name_contains': 'Widget'
+                }, follow_redirects=True)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn(b'The value must be a finite number.', response.data)
+
     # 4. Product View Test (for Users)
     def test_user_view_all_products(self): # GREEN
         """
@@ -217,6 +399,133 @@ class EcommerceTestCase(unittest.TestCase):
             response = client.get('/', follow_redirects=True)
             self.assertIn(b'Test Product', response.data)
 
+    def test_product_listing_is_streamed_and_cached(self):
+        """
+        Test that a miss on a listing that was large last time is streamed, and the next
+        view is served from the fragment cache.
+        """
+        self.create_product('Test Product', 'Test Description', 10.0, 100)
+        self.create_product('Other Product', 'Test Description', 5.0, 10)
+
+        app.config['LISTING_STREAM_THRESHOLD'] = 1
+        try:
+            response = self.client.get('/')
+            self.assertIsNotNone(response.content_length)  # Size unknown until rendered once
+
+            self.create_product('New Product', 'Test Description', 5.0, 10)
+            response = self.client.get('/')
+            self.assertIsNone(response.content_length)  # Streamed bodies have no length
+            self.assertIn(b'New Product', response.data)
+
+            response = self.client.get('/')
+            self.assertIsNotNone(response.content_length)
+            self.assertIn(b'New Product', response.data)
+        finally:
+            app.config['LISTING_STREAM_THRESHOLD'] = 200
+
+    def test_product_listing_cache_invalidated_on_edit(self):
+        """
+        Test that editing a product invalidates the cached listing.
+        """
+        self.create_user('admin', 'admin')
+        self.db.query(User).filter_by(username='admin').update({"is_admin": True})
+        product_id = self.create_product('Test Product', 'Test Description', 10.0, 100).id
+
+        with self.client as client:
+            self.login_user('admin', 'admin')
+            self.assertIn(b'Test Product', client.get('/').data)
+            client.post(f'/admin/products/edit/{product_id}', data={
+                'name': 'Renamed Product',
+                'description': 'Test Description',
+                'price': '10.0',
+                'stock': '100'
+            })
+            response = client.get('/')
+            self.assertIn(b'Renamed Product', response.data)
+            self.assertNotIn(b'Test Product', response.data)
+
+    def test_product_listing_sees_changes_from_other_workers(self):
+        """
+        Test that the listing cache follows the persisted catalog version, so a write made
+        outside this process is not hidden behind a cached fragment.
+        """
+        product_id = self.create_product('Test Product', 'Test Description', 10.0, 100).id
+        self.assertIn(b'Test Product', self.client.get('/').data)
+
+        self.db.get(Product, product_id).name = 'Renamed Product'  # As another worker would
+        self.db.commit()
+        response = self.client.get('/')
+        self.assertIn(b'Renamed Product', response.data)
+        self.assertNotIn(b'Test Product', response.data)
+
+    def test_fingerprinted_asset_served_precompressed(self):
+        """
+        Test that built assets are linked by hashed name and served gzipped with immutable caching.
+        """
+        static_folder, manifest = app.static_folder, app.asset_manifest
+        with tempfile.TemporaryDirectory() as tmp:
+            css = b'body { color: white; }\n' * 50
+            with open(os.path.join(tmp, 'style.css'), 'wb') as f:
+                f.write(css)
+            app.static_folder = tmp
+            app.asset_manifest = build_assets(tmp)
+            try:
+                url = f"/static/dist/{app.asset_manifest['style.css']}"
+                self.assertIn(url.encode(), self.client.get('/').data)
+
+                response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+                self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+                self.assertEqual(response.mimetype, 'text/css')
+                self.assertIn('immutable', response.headers['Cache-Control'])
+                self.assertEqual(gzip.decompress(response.data), css)
+                response.close()
+
+                response = self.client.get(url)
+                self.assertNotIn('Content-Encoding', response.headers)
+                self.assertEqual(response.data, css)
+                response.close()
+            finally:
+                app.static_folder, app.asset_manifest = static_folder, manifest
+
+    def test_large_page_compressed_with_gzip(self):
+        """
+        Test that large pages are gzipped when accepted, and the ratio is recorded per route.
+        """
+        for i in range(50):
+            self.create_product(f'Product {i}', 'Test Description', 10.0, 100)
+        app.compression_stats.clear()
+
+        response = self.client.get('/')
+        self.assertNotIn('Content-Encoding', response.headers)
+        plain = response.data
+
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data), plain)
+        self.assertGreater(app.compression_stats.snapshot()['index']['ratio'], 1.0)
+
+    def test_streamed_page_compressed_and_small_page_skipped(self):
+        """
+        Test that streamed listings are compressed and bodies under the threshold are not.
+        """
+        for i in range(50):
+            self.create_product(f'Product {i}', 'Test Description', 10.0, 100)
+
+        app.config['LISTING_STREAM_THRESHOLD'] = 1
+        try:
+            self.client.get('/')
+            self.create_product('Product 50', 'Test Description', 10.0, 100)
+            response = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+            self.assertIsNone(response.content_length)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertIn(b'Product 49', gzip.decompress(response.data))
+        finally:
+            app.config['LISTING_STREAM_THRESHOLD'] = 200
+
+        response = self.client.get('/logout', headers={'Accept-Encoding': 'gzip'})  # Redirect to login
+        self.assertNotIn('Content-Encoding', response.headers)
+
     # 5. Cart and Order Test
     def test_add_product_to_cart(self): # GREEN
         """
@@ -238,6 +547,70 @@ class EcommerceTestCase(unittest.TestCase):
             self.assertIn(b'Cart', response.data)  # Check if cart is updated
 
 
+    def test_guest_cart_merged_on_login(self):
+        """
+        Test that a guest cart makes no cart_items writes and is merged into the persistent cart at login.
+        """
+        first_id = self.create_product('First Product', 'Test Description', 10.0, 100).id
+        second_id = self.create_product('Second Product', 'Test Description', 5.0, 100).id
+        self.db.add(CartItem(user_id=self.test_user.id, product_id=first_id, quantity=1))
+        self.db.commit()
+
+        with self.client as client:
+            client.get(f'/cart/add/{first_id}')
+            client.get(f'/cart/add/{second_id}')
+            response = client.get(f'/cart/add/{second_id}', follow_redirects=True)
+            self.assertIn(b'Second Product', response.data)
+            self.assertIn(b'to place your order', response.data)
+            self.assertEqual(self.db.query(CartItem).count(), 1)
+
+            response = self.login_user('testuser', 'testpass')
+            self.assertIn(b'Place Order', response.data)
+            quantities = {item.product_id: item.quantity for item in self.db.query(CartItem)}
+            self.assertEqual(quantities, {first_id: 2, second_id: 2})
+
+    def test_guest_cart_kept_when_merge_fails(self):
+        """
+        Test that a failed merge at login keeps the guest cart for the next login.
+        """
+        product_id = self.create_product('Test Product', 'Test Description', 10.0, 100).id
+
+        with self.client as client:
+            client.get(f'/cart/add/{product_id}')
+            CartItem.__table__.drop(self.engine)
+            with self.assertLogs(level='ERROR'):
+                response = self.login_user('testuser', 'testpass')
+            self.assertIn(b'Your cart could not be restored', response.data)
+            CartItem.__table__.create(self.engine)
+
+            client.get('/logout')
+            self.login_user('testuser', 'testpass')
+            self.assertEqual(self.db.query(CartItem).one().product_id, product_id)
+
+    def test_purge_abandoned_carts(self):
+        """
+        Test that only carts whose every item is untouched past the cutoff are purged, in
+        chunks, and that items predating timestamps are stamped instead of purged.
+        """
+        product_id = self.create_product('Test Product', 'Test Description', 10.0, 100).id
+        users = [self.create_user(f'shopper{i}', 'testpass').id for i in range(3)]
+        old = utcnow() - timedelta(days=60)
+        self.db.add_all([CartItem(user_id=user_id, product_id=product_id, updated_at=old) for user_id in users])
+        self.db.add_all([CartItem(user_id=self.test_user.id, product_id=product_id, updated_at=old) for _ in range(2)])
+        self.db.add(CartItem(user_id=self.test_user.id, product_id=product_id))
+        self.db.commit()
+        untimed = CartItem(user_id=users[0], product_id=product_id)
+        self.db.add(untimed)
+        self.db.commit()
+        self.db.query(CartItem).filter_by(id=untimed.id).update({CartItem.updated_at: None})
+        self.db.commit()
+
+        self.assertEqual(stamp_untimed_carts(self.db), 1)
+        deleted = purge_abandoned_carts(self.db, utcnow() - timedelta(days=30), chunk_size=1)
+        self.assertEqual(deleted, 2)
+        self.assertEqual(sorted(user_id for (user_id,) in self.db.query(CartItem.user_id)),
+                         sorted([users[0], users[0]] + [self.test_user.id] * 3))
+
     def test_view_cart_contents(self): # GREEN
         """
         Test viewing the cart contents.
@@ -275,7 +648,7 @@ class EcommerceTestCase(unittest.TestCase):
             response = client.get(f'/cart/add/{db_product.id}', follow_redirects=True)
             self.assertIn(b'Product added to cart.', response.data)
 
-            response = client.get('/order/place', follow_redirects=True)
+            response = client.post('/order/place', follow_redirects=True)
             self.assertIn(b'Order placed successfully.', response.data)
 
             response = client.get('/cart', follow_redirects=True)
@@ -300,6 +673,441 @@ class EcommerceTestCase(unittest.TestCase):
         order = self.db.query(Order).filter_by(user_id=user_id).first()
         self.assertIsNotNone(order, "Order was not stored in the database.")
 
+    def test_place_order_replayed_for_same_idempotency_key(self):
+        """
+        Test that retrying a checkout with the same key replays the result instead of ordering twice.
+        """
+        product_id = self.create_product('Test Product', 'Test Description', 10.0, 100).id
+
+        with self.client as client:
+            self.login_user('testuser', 'testpass')
+            client.get(f'/cart/add/{product_id}')
+            for _ in range(2):
+                response = client.post('/order/place', data={'idempotency_key': 'checkout-1'}, follow_redirects=True)
+                self.assertIn(b'Order placed successfully.', response.data)
+
+            self.assertEqual(self.db.query(Order).count(), 1)
+            self.assertEqual(self.db.get(Product, product_id).stock, 99)
+
+            client.get(f'/cart/add/{product_id}')
+            client.post('/order/place', data={'idempotency_key': 'checkout-2'})
+            self.assertEqual(self.db.query(Order).count(), 2)
+
+    def test_place_order_key_persisted_across_workers(self):
+        """
+        Test that a retry reaching a worker that never saw the key still does not order twice.
+        """
+        product_id = self.create_product('Test Product', 'Test Description', 10.0, 100).id
+
+        with self.client as client:
+            self.login_user('testuser', 'testpass')
+            client.get(f'/cart/add/{product_id}')
+            client.post('/order/place', data={'idempotency_key': 'checkout-1'})
+            app.idempotency_store.clear()  # Another worker, or a restart
+            client.get(f'/cart/add/{product_id}')
+            response = client.post('/order/place', data={'idempotency_key': 'checkout-1'}, follow_redirects=True)
+            self.assertIn(b'Order placed successfully.', response.data)
+
+        self.assertEqual(self.db.query(Order).count(), 1)
+        self.assertEqual(self.db.query(Order).one().idempotency_key, 'checkout-1')
+        self.assertEqual(self.db.get(Product, product_id).stock, 99)
+        self.assertEqual(self.db.query(CartItem).count(), 1)
+
+    def test_place_order_rejects_overlong_idempotency_key(self):
+        """
+        Test that a key longer than the order stores is refused rather than truncated, so
+        keys sharing their first 64 characters cannot replay each other's checkout.
+        """
+        product_id = self.create_product('Test Product', 'Test Description', 10.0, 100).id
+
+        with self.client as client:
+            self.login_user('testuser', 'testpass')
+            client.get(f'/cart/add/{product_id}')
+            response = client.post('/order/place', headers={'Idempotency-Key': 'k' * 65})
+            self.assertEqual(response.status_code, 400)
+            response = client.post('/order/place', headers={'Idempotency-Key': 'k' * 64}, follow_redirects=True)
+            self.assertIn(b'Order placed successfully.', response.data)
+
+        self.assertEqual(self.db.query(Order).one().idempotency_key, 'k' * 64)
+
+    def test_orders_listed_after_product_deleted(self):
+        """
+        Test that orders of a deleted product are still listed, with the product marked as removed.
+        """
+        product_id = self.create_product('Test Product', 'Test Description', 10.0, 100).id
+        self.db.add(Order(user_id=self.test_user.id, total_price=10.0,
+                          items=[OrderItem(product_id=product_id, quantity=3)]))
+        self.db.commit()
+        self.db.delete(self.db.get(Product, product_id))
+        self.db.commit()
+
+        with self.client as client:
+            self.login_user('testuser', 'testpass')
+            response = client.get('/orders')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'(product removed) - Quantity: 3', response.data)
+
+    def test_place_order_rejects_get(self):
+        """
+        Test that checkout cannot be triggered by a GET (prefetches, plain links).
+        """
+        self.login_user('testuser', 'testpass')
+        self.assertEqual(self.client.get('/order/place').status_code, 405)
+
+    def test_place_order_writes_outbox_event(self):
+        """
+        Test that checkout records an outbox event that the worker later handles.
+        """
+        product_id = self.create_product('Test Product', 'Test Description', 10.0, 1).id
+
+        with self.client as client:
+            self.login_user('testuser', 'testpass')
+            client.get(f'/cart/add/{product_id}')
+            client.post('/order/place')
+
+        event = self.db.query(OutboxEvent).one()
+        self.assertEqual(event.topic, 'order_placed')
+        self.assertIsNone(event.processed_at)
+        self.assertEqual(app.outbox_worker.metrics()['queue_depth'], 1)
+
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertEqual(app.outbox_worker.drain_once(), 1)
+        self.assertIn('Low stock', logs.output[0])
+        self.assertIsNotNone(self.db.query(OutboxEvent).one().processed_at)
+        self.assertEqual(app.outbox_worker.metrics()['queue_depth'], 0)
+
+    def test_outbox_failed_event_backs_off(self):
+        """
+        Test that a failing handler leaves the event pending with a delayed retry.
+        """
+        worker = OutboxWorker(lambda shard: self.Session(), backoff=60.0)
+
+        @worker.handler('broken')
+        def broken(db, payload):
+            raise RuntimeError('boom')
+
+        enqueue(self.db, 'broken', {})
+        self.db.commit()
+
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(worker.drain_once(), 1)
+        event = self.db.query(OutboxEvent).one()
+        self.assertEqual(event.attempts, 1)
+        self.assertIn('boom', event.last_error)
+        self.assertIsNone(event.processed_at)
+        self.assertEqual(worker.drain_once(), 0)  # Not due again until the backoff has passed
+
+    def test_purge_processed_outbox_events(self):
+        """
+        Test that only events handled before the cutoff are purged, in chunks, while
+        pending and dead events stay.
+        """
+        old = utcnow() - timedelta(days=30)
+        self.db.add_all([OutboxEvent(topic='done', payload='{}', processed_at=old) for _ in range(3)])
+        self.db.add(OutboxEvent(topic='recent', payload='{}', processed_at=utcnow()))
+        self.db.add(OutboxEvent(topic='pending', payload='{}'))
+        self.db.add(OutboxEvent(topic='dead', payload='{}', created_at=old, attempts=5))
+        self.db.commit()
+
+        self.assertEqual(purge_processed(self.db, utcnow() - timedelta(days=7), chunk_size=2), 3)
+        self.assertEqual(sorted(topic for (topic,) in self.db.query(OutboxEvent.topic)), ['dead', 'pending', 'recent'])
+
+    def test_outbox_worker_threads_drain_events(self):
+        """
+        Test that the started worker threads handle events, outside any request or app context.
+        """
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        engine = create_engine(f"sqlite:///{os.path.join(tmp.name, 'outbox.db')}")
+        self.addCleanup(engine.dispose)
+        Base.metadata.create_all(bind=engine)
+        sessions = scoped_session(sessionmaker(bind=engine))
+        app.SessionLocal = sessions
+        enqueue(sessions(), 'unhandled', {})
+        sessions().commit()
+        sessions.remove()
+
+        worker = app.outbox_worker
+        self.addCleanup(setattr, worker, 'poll_interval', worker.poll_interval)
+        worker.poll_interval = 0.05
+        worker.start()
+        self.addCleanup(worker.stop, 5.0)
+        db = sessions()
+        deadline = time.monotonic() + 5.0
+        while db.query(OutboxEvent).filter(OutboxEvent.processed_at.is_(None)).count() and time.monotonic() < deadline:
+            db.rollback()
+            time.sleep(0.05)
+        self.assertIsNotNone(db.query(OutboxEvent).one().processed_at)
+        db.close()
+
+    def test_archived_orders_paged_after_hot_orders(self):
+        """
+        Test that old orders are archived in chunks and listed on their own pages, which the
+        pages of hot orders never read.
+        """
+        product_id = self.create_product('Test Product', 'Test Description', 10.0, 100).id
+        now = utcnow()
+        for days in range(5):
+            self.db.add(Order(user_id=self.test_user.id, total_price=float(days), timestamp=now - timedelta(days=days * 200),
+                              items=[OrderItem(product_id=product_id, quantity=1)]))
+        self.db.commit()
+
+        self.assertEqual(archive_orders(self.db, now - timedelta(days=365), chunk_size=2), 3)
+        self.assertEqual(self.db.query(Order).count(), 2)
+        self.assertEqual(self.db.query(ArchivedOrder).count(), 3)
+        self.assertEqual(self.db.query(OrderItem).count(), 2)
+
+        orders, has_next = load_order_page(self.db, self.test_user.id, 1, 3)
+        self.assertEqual([order.total_price for order in orders], [0.0, 1.0])
+        self.assertFalse(has_next)
+        orders, has_next = load_order_page(self.db, self.test_user.id, 1, 2, archived=True)
+        self.assertEqual([order.total_price for order in orders], [2.0, 3.0])
+        self.assertTrue(has_next)
+        orders, has_next = load_order_page(self.db, self.test_user.id, 2, 2, archived=True)
+        self.assertEqual([order.total_price for order in orders], [4.0])
+        self.assertFalse(has_next)
+        self.assertEqual(orders[0].items[0].product.name, 'Test Product')
+
+        with self.client as client:
+            self.login_user('testuser', 'testpass')
+            with app.query_profiler.capture() as queries:
+                response = client.get('/orders')
+            self.assertNotIn('orders_archive', ' '.join(query.statement for query in queries))
+            self.assertIn(b'Archived orders', response.data)
+            response = client.get('/orders?archived=1')
+            self.assertIn(b'My Archived Orders', response.data)
+            self.assertIn(b'Total Price: $4.0', response.data)
+
+    def test_archive_after_hot_orders_emptied(self):
+        """
+        Test that orders placed after the hot table emptied get new ids and archive again.
+        """
+        product_id = self.create_product('Test Product', 'Test Description', 10.0, 100).id
+        old = utcnow() - timedelta(days=400)
+        for total in (1.0, 2.0):
+            self.db.add(Order(user_id=self.test_user.id, total_price=total, timestamp=old,
+                              items=[OrderItem(product_id=product_id, quantity=1)]))
+            self.db.commit()
+            self.assertEqual(archive_orders(self.db, utcnow() - timedelta(days=365)), 1)
+
+        self.assertEqual(sorted(order.id for order in self.db.query(ArchivedOrder)), [1, 2])
+        self.assertEqual(self.db.query(ArchivedOrderItem).count(), 2)
+
+    def test_upgrade_rebuilds_order_tables_with_autoincrement(self):
+        """
+        Test that upgrading a database whose order tables predate AUTOINCREMENT keeps their
+        rows and hands out ids above the archived ones.
+        """
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        engine = create_engine(f"sqlite:///{os.path.join(tmp.name, 'old.db')}")
+        self.addCleanup(engine.dispose)
+        Base.metadata.create_all(bind=engine)
+        with engine.begin() as connection:
+            for statement in (
+                'DROP TABLE order_items',
+                'DROP TABLE orders',
+                'CREATE TABLE orders (id INTEGER NOT NULL PRIMARY KEY, user_id INTEGER, timestamp DATETIME, total_price FLOAT)',
+                'CREATE TABLE order_items (id INTEGER NOT NULL PRIMARY KEY, order_id INTEGER REFERENCES orders (id), '
+                'product_id INTEGER, quantity INTEGER)',
+                "INSERT INTO orders (id, user_id, total_price) VALUES (1, 1, 5.0)",
+                "INSERT INTO order_items (id, order_id, product_id, quantity) VALUES (1, 1, 1, 1)",
+                "INSERT INTO orders_archive (id, user_id, total_price) VALUES (7, 1, 3.0)",
+            ):
+                connection.execute(text(statement))
+        self.assertIn('AUTOINCREMENT on orders', missing_schema(engine, Base.metadata))
+        self.assertIn('column orders.idempotency_key', missing_schema(engine, Base.metadata))
+
+        upgrade_schema(engine, Base.metadata)
+        self.assertEqual(missing_schema(engine, Base.metadata), [])
+        db = sessionmaker(bind=engine)()
+        reserve_archived_ids(db)
+        self.assertEqual(db.get(Order, 1).items[0].quantity, 1)
+        self.assertIsNone(db.get(Order, 1).idempotency_key)
+        db.add(Order(user_id=1, total_price=1.0))
+        db.commit()
+        self.assertEqual(db.query(Order.id).order_by(Order.id.desc()).first()[0], 8)
+        db.close()
+
+    def use_shards(self, count):
+        """
+        Helper function to route carts and orders to temporary shard files for one test.
+        """
+        tmp = tempfile.TemporaryDirectory()
+        router = ShardRouter([f'sqlite:///{os.path.join(tmp.name, f"shard{i}.db")}' for i in range(count)])
+        unsharded, app.shards = app.shards, router
+        self.addCleanup(tmp.cleanup)
+        self.addCleanup(router.dispose)
+        self.addCleanup(setattr, app, 'shards', unsharded)
+        return router
+
+    def test_sharded_checkout_writes_to_user_shard(self):
+        """
+        Test that carts and orders of a user live in the user's shard, not the catalog, and
+        that the outbox takes the sold stock out of the catalog.
+        """
+        router = self.use_shards(2)
+        product_id = self.create_product('Test Product', 'Test Description', 10.0, 5).id
+        users = [self.create_user(f'shopper{i}', 'testpass').id for i in range(4)]
+
+        for i, user_id in enumerate(users):
+            with app.test_client() as client:
+                client.post('/login', data={'username': f'shopper{i}', 'password': 'testpass'})
+                self.place_order_and_verify_cart(client, product_id)
+                self.assertIn(b'Test Product', client.get('/orders').data)
+
+        for user_id in users:
+            shard = router.session(user_id)
+            self.assertEqual(shard.query(Order).filter_by(user_id=user_id).count(), 1)
+            self.assertEqual(shard.query(CartItem).filter_by(user_id=user_id).count(), 0)
+            shard.close()
+        self.assertEqual(self.db.query(Order).count(), 0)
+        self.assertEqual(self.db.get(Product, product_id).stock, 5)
+
+        worker = OutboxWorker(lambda shard: router.session_for_shard(shard), shards=router.count)
+        worker.handlers = app.outbox_worker.handlers
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(worker.drain_once(), len(users))
+        self.db.expire_all()
+        self.assertEqual(self.db.get(Product, product_id).stock, 1)
+
+    def test_sharded_checkout_does_not_write_to_catalog(self):
+        """
+        Test that once a shard holds an allocation of a product, checkouts selling it only
+        write to the shard, and that reconciling the same totals twice counts them once.
+        """
+        router = self.use_shards(2)
+        product_id = self.create_product('Test Product', 'Test Description', 10.0, 100).id
+        catalog_commits = []
+        event.listen(self.engine, 'commit', catalog_commits.append)  # The engine is dropped after the test
+
+        with self.client as client:
+            self.login_user('testuser', 'testpass')
+            self.place_order_and_verify_cart(client, product_id)  # Takes an allocation
+            del catalog_commits[:]
+            self.place_order_and_verify_cart(client, product_id)
+        self.assertEqual(catalog_commits, [])
+
+        shard_number = router.shard_of(self.test_user.id)
+        shard = router.session(self.test_user.id)
+        self.assertEqual(shard.get(ShardStock, product_id).sold, 2)
+        self.assertEqual(reconcile_stock(self.db, shard, shard_number), 1)
+        self.assertEqual(reconcile_stock(self.db, shard, shard_number), 0)
+        shard.close()
+        self.db.expire_all()
+        self.assertEqual(self.db.get(Product, product_id).stock, 98)
+        allocation = self.db.get(StockAllocation, (shard_number, product_id))
+        self.assertEqual((allocation.quantity, allocation.sold), (app.config['STOCK_ALLOCATION_CHUNK'], 2))
+
+    def test_stranded_stock_released_to_other_shards(self):
+        """
+        Test that stock allocated to a shard that does not sell it is handed back by
+        `flask settle-stock`, so users of other shards can buy it.
+        """
+        router = self.use_shards(2)
+        product_id = self.create_product('Test Product', 'Test Description', 10.0, 2).id
+        users = {}
+        while len(users) < 2:
+            user = self.create_user(f'shopper{len(self.db.query(User).all())}', 'testpass')
+            users.setdefault(shard_index(user.id, 2), user)
+        self.assertTrue(allocate_stock(self.db, 0, product_id, 2, chunk=20, shards=1))
+
+        with app.test_client() as client:
+            client.post('/login', data={'username': users[1].username, 'password': 'testpass'})
+            client.get(f'/cart/add/{product_id}')
+            response = client.post('/order/place', follow_redirects=True)
+            self.assertIn(b'out of stock', response.data)
+
+            result = app.test_cli_runner().invoke(args=['settle-stock'])
+            self.assertIn('Released the unsold stock of 1 shard allocations.', result.output)
+            response = client.post('/order/place', follow_redirects=True)
+            self.assertIn(b'Order placed successfully.', response.data)
+
+        shard = router.session_for_shard(0)
+        self.assertEqual(shard.get(ShardStock, product_id).released, 2)
+        shard.close()
+        self.db.expire_all()
+        self.assertEqual(self.db.get(StockAllocation, (0, product_id)).released, 2)
+
+    def test_rebalance_moves_users_to_new_shards(self):
+        """
+        Test that rebalancing moves orders and their items to the user's new shard.
+        """
+        old = self.use_shards(1)
+        product_id = self.create_product('Test Product', 'Test Description', 10.0, 100).id
+        users = [self.create_user(f'shopper{i}', 'testpass').id for i in range(4)]
+        shard = old.session_for_shard(0)
+        for user_id in users:
+            shard.add(Order(user_id=user_id, total_price=10.0, items=[OrderItem(product_id=product_id, quantity=1)]))
+            shard.add(CartItem(user_id=user_id, product_id=product_id, quantity=2))
+        shard.commit()
+        shard.close()
+
+        new = self.use_shards(2)
+        self.assertEqual(rebalance(old, new, users), len(users))
+        for user_id in users:
+            db = new.session(user_id)
+            order = db.query(Order).filter_by(user_id=user_id).one()
+            self.assertEqual([item.quantity for item in order.items], [1])
+            self.assertEqual(db.query(CartItem).filter_by(user_id=user_id).one().quantity, 2)
+            db.close()
+        db = old.session_for_shard(0)
+        self.assertEqual(db.query(Order).count() + db.query(OrderItem).count() + db.query(CartItem).count(), 0)
+        db.close()
+
+    def test_read_routes_within_query_budget(self):
+        """
+        Test that the read routes use indexes and a fixed, small number of statements.
+        """
+        product_ids = [self.create_product(f'Product {i}', 'Test Description', 10.0, 100).id for i in range(3)]
+        for product_id in product_ids:
+            self.db.add(Order(user_id=self.test_user.id, total_price=10.0,
+                              items=[OrderItem(product_id=product_id, product_name=f'Product {product_id}', quantity=1)]))
+            self.db.add(CartItem(user_id=self.test_user.id, product_id=product_id, quantity=1))
+        self.db.commit()
+
+        self.login_user('testuser', 'testpass')
+        self.assert_query_budget('GET', '/orders', 2)  # User, orders with their items
+        self.assert_query_budget('GET', '/cart', 3)  # User, cart items, products
+        self.assert_query_budget('GET', '/catalog/changes?since=1', 2)  # Products, tombstones
+        self.assert_query_budget('GET', '/', 3, allow_scans=('products',))  # User, catalog version, products
+
+    def test_place_order_query_count_independent_of_cart_size(self):
+        """
+        Test that checkout runs the same statements for one product as for many.
+        """
+        product_ids = [self.create_product(f'Product {i}', 'Test Description', 10.0, 100).id for i in range(6)]
+        counts = []
+        self.login_user('testuser', 'testpass')
+        for cart in (product_ids[:1], product_ids[1:]):
+            for product_id in cart:
+                self.client.get(f'/cart/add/{product_id}')
+            counts.append(self.assert_query_budget('POST', '/order/place', 9))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(self.db.query(OrderItem).count(), 6)
+
+    def test_sql_profiling_reports_scans_and_repeats(self):
+        """
+        Test that profiling mode reports each request's statements and flags full scans.
+        """
+        self.create_product('Test Product', 'Test Description', 10.0, 100)
+        app.config['SQL_PROFILING'] = True
+        self.addCleanup(app.config.__setitem__, 'SQL_PROFILING', False)
+
+        with self.assertLogs(level='WARNING') as logs:
+            self.client.get('/')
+        report = app.query_profiler.reports[-1]
+        self.assertEqual(report['route'], 'index')
+        self.assertEqual(report['queries'], 2)
+        self.assertIn('products', report['scans'][0]['tables'])
+        self.assertIn('full scan of products', logs.output[0])
+
+        record = QueryRecord('SELECT * FROM products WHERE id = ?', 1.0, ['SEARCH products USING INTEGER PRIMARY KEY (rowid=?)'])
+        summary = summarize([record, record], slow_ms=1.0)
+        self.assertEqual(summary['scans'], [])
+        self.assertEqual(summary['repeated'], {record.statement: 2})
+        self.assertEqual(len(summary['slow']), 2)
+
     # 6. Error Handling Test
     def test_unauthorized_access_to_admin_routes(self): # GREEN
         """
@@ -333,6 +1141,18 @@ class EcommerceTestCase(unittest.TestCase):
             }, follow_redirects=True)
             self.assertIn(b'Username cannot be empty.', response.data)
 
+    def test_read_session_routes_to_writer_after_commit(self):
+        """
+        Test that reads use the read-only pool until the request commits a write.
+        """
+        read_sessions = scoped_session(sessionmaker(bind=self.engine))
+        app.ReadSessionLocal = read_sessions
+        with app.test_request_context('/'):
+            self.assertIs(read_session(), read_sessions())
+            self.Session().commit()
+            self.assertIs(read_session(), self.Session())
+        read_sessions.remove()
+
     # 7. Persistence Test
     def test_data_saved_in_database(self): # GREEN
         """